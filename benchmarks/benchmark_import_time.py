@@ -0,0 +1,68 @@
+"""
+This script checks the import time of the modules in the package, each in a fresh Python process, against a budget.
+It also checks that the modules that do not plot do not import matplotlib or seaborn (plot_module imports them
+when a plot function is called), so that headless scripts and worker processes do not pay for the plotting libraries.
+The import time includes numpy and pandas, which all the modules need.
+
+The script exits with status 1 if any module is over the budget or imports the plotting libraries.
+
+Usage:
+python benchmarks/benchmark_import_time.py
+python benchmarks/benchmark_import_time.py --budget-ms 1500 --repeat 5
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+_MODULES = ['dt_ids7_export_module', 'mapping_module', 'reporting_module', 'exposure_module', 'store_module',
+            'plot_module', 'instrumentation_module', 'synthetic_data_module', 'batch_report_module',
+            'query_module']
+
+_PLOTTING_LIBRARIES = ['matplotlib', 'seaborn']
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import xa_dose_analysis.{module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'plotting': [name for name in {plotting} if name in sys.modules]}}))
+"""
+
+def measure_import(module):
+    """
+    Imports the module in a fresh Python process, and returns the import time in seconds and the plotting libraries
+    that were imported.
+    """
+    script = _IMPORT_SCRIPT.format(module=module, plotting=_PLOTTING_LIBRARIES)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['seconds'], result['plotting']
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the modules against a budget.')
+    parser.add_argument('--budget-ms', type=float, default=1000, help='Largest allowed import time per module (ms).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of imports per module, the fastest is used.')
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"Module":<25} {"Import (ms)":>12}  Plotting libraries')
+    for module in _MODULES:
+        results = [measure_import(module) for _ in range(args.repeat)]
+        milliseconds = min(seconds for seconds, _ in results) * 1000
+        plotting = results[0][1]
+        status = ''
+        if milliseconds > args.budget_ms:
+            status += '  OVER BUDGET'
+            failed = True
+        if plotting:
+            status += '  IMPORTS PLOTTING LIBRARIES'
+            failed = True
+        print(f'{module:<25} {milliseconds:12.0f}  {", ".join(plotting) or "-"}{status}')
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+This script times the main steps of the analysis on synthetic data (see synthetic_data_module), so that the performance
+can be measured without the real exports:
+ingestion (import_excel_files_to_dataframe, with and without the Parquet cache)
+cleanup (run_all_cleanup_filters_and_checks)
+merge (merge_ids7_dt)
+mapping (map_procedures with the PCI mapping dictionary)
+confidence interval (_calc_ci of the DAP, on at most --ci-max-rows values, as the bootstrap grows with rows x resamples)
+angle heatmap (angle_heatmap_grid and build_angle_histogram_cube on the exposure level data)
+exposure aggregation (aggregate_exposures of the exposure level data to procedure level rows)
+
+The sizes are the number of IDS7 rows (and exposure level rows). Writing and reading Excel files is slow, so the
+ingestion is only timed up to --excel-max-rows rows.
+
+Usage:
+python benchmarks/benchmark_pipeline.py
+python benchmarks/benchmark_pipeline.py --sizes 10000 100000 --output benchmark.csv
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import tempfile
+import time
+
+import pandas as pd
+
+from xa_dose_analysis import dt_ids7_export_module as bh_utils
+from xa_dose_analysis import mapping_module as bh_map
+from xa_dose_analysis import reporting_module as bh_report
+from xa_dose_analysis import exposure_module as bh_exp
+from xa_dose_analysis import synthetic_data_module as bh_synth
+from xa_dose_analysis.mapping_dicts import mapping_dict_PCI
+
+def _time_stage(results, n_rows, stage, func, *args, **kwargs):
+    """
+    Runs the function once with the printed output suppressed, records the wall time, and returns the result.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    results.append({'Rows': n_rows, 'Stage': stage, 'Seconds': seconds})
+    print(f'{n_rows:>10}  {stage:<30} {seconds:10.3f} s')
+    return result
+
+def run_benchmark(sizes, seed=1, excel_max_rows=200000, excel_rows_per_file=50000, n_workers=1, ci_max_rows=100000):
+    """
+    Runs all the stages for each size, and returns a dataframe with the wall time of each stage.
+    """
+    results = []
+    for n_rows in sizes:
+        df_ids7, df_dt, df_dt_exp = _time_stage(results, n_rows, 'generate synthetic data',
+                                                bh_synth.generate_dataset, n_rows, seed=seed)
+
+        if n_rows <= excel_max_rows:
+            with tempfile.TemporaryDirectory() as folder:
+                n_files = max(1, -(-n_rows // excel_rows_per_file))
+                bh_synth.write_excel_files(df_ids7, folder + '/ids7', n_files=n_files, prefix='ids7')
+                _time_stage(results, n_rows, 'ingestion', bh_utils.import_excel_files_to_dataframe,
+                            folder + '/ids7', n_workers=n_workers)
+                if importlib.util.find_spec('pyarrow') is not None:
+                    # The first read fills the cache, the second read is from the cache:
+                    _time_stage(results, n_rows, 'ingestion (fill cache)', bh_utils.import_excel_files_to_dataframe,
+                                folder + '/ids7', n_workers=n_workers, cache_folder=folder + '/cache')
+                    _time_stage(results, n_rows, 'ingestion (from cache)', bh_utils.import_excel_files_to_dataframe,
+                                folder + '/ids7', n_workers=n_workers, cache_folder=folder + '/cache')
+
+        df_ids7 = _time_stage(results, n_rows, 'cleanup', bh_utils.run_all_cleanup_filters_and_checks, df_ids7, df_dt)
+        data = _time_stage(results, n_rows, 'merge_ids7_dt', bh_utils.merge_ids7_dt, df_ids7, df_dt)
+        data = _time_stage(results, n_rows, 'map_procedures', bh_map.map_procedures, data,
+                           mapping_dict_PCI.get_PCI_mapping_dict())
+        _time_stage(results, n_rows, '_calc_ci', bh_report._calc_ci, data['DAP Total (Gy*cm2)'].dropna().iloc[:ci_max_rows],
+                    seed=seed)
+        _time_stage(results, n_rows, 'angle_heatmap_grid', bh_exp.angle_heatmap_grid,
+                    df_dt_exp['Positioner Primary Angle (deg)'], df_dt_exp['Positioner Secondary Angle (deg)'],
+                    df_dt_exp['Air Kerma (mGy)'])
+        _time_stage(results, n_rows, 'build_angle_histogram_cube', bh_exp.build_angle_histogram_cube, df_dt_exp)
+        _time_stage(results, n_rows, 'aggregate_exposures', bh_exp.aggregate_exposures, df_dt_exp)
+
+    return pd.DataFrame(results)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the analysis steps on synthetic IDS7 and DoseTrack data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 10000000],
+                        help='Number of IDS7 (and exposure level) rows to benchmark.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic data and the bootstrap.')
+    parser.add_argument('--excel-max-rows', type=int, default=200000,
+                        help='Largest size for which the Excel ingestion is timed.')
+    parser.add_argument('--ci-max-rows', type=int, default=100000,
+                        help='Largest number of values used for the bootstrap confidence interval.')
+    parser.add_argument('--n-workers', type=int, default=1, help='Number of worker processes for the ingestion.')
+    parser.add_argument('--output', help='Write the results to this CSV file.')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, seed=args.seed, excel_max_rows=args.excel_max_rows,
+                            n_workers=args.n_workers, ci_max_rows=args.ci_max_rows)
+    print('\n')
+    print(results.pivot(index='Stage', columns='Rows', values='Seconds').reindex(results['Stage'].unique()).round(3))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+This module contains the command line tool xa-dose-report, which runs the same steps as the department notebooks
+from a job file, without a notebook:
+The IDS7 and DoseTrack exports are imported, cleaned (run_all_cleanup_filters_and_checks) and merged (merge_ids7_dt)
+once, and then each department is reported in its own worker process:
+the merged data is filtered to the rooms of the department, mapped with the mapping dictionary of the department,
+and plot_representative_dose, report_exposure_time_all and report_exposure_time_per_lab are run for each procedure.
+
+For each department, the output folder gets a subfolder with:
+report.txt:     Everything that is printed for the department (the mapping warnings and the summaries).
+Figures/:       The plots of each procedure.
+summary.csv:    The summary tables of all the procedures.
+
+Usage:
+xa-dose-report report_2025.toml
+xa-dose-report report_2025.toml --n-workers 4
+
+Example of a job file (TOML):
+
+[data]
+ids7_folder = "/data/IDS7/2025"
+dt_folder = "/data/DoseTrack - Serienivå/2025"
+n_workers = 4                       # Optional: number of processes for reading the Excel files.
+cache_folder = "/data/cache"        # Optional: Parquet cache of the Excel files.
+store_folder = "/data/store"        # Optional: use the incremental store (update_merged_store) instead.
+review_file = "review_2025.csv"     # Optional: ambiguous accession numbers are written here.
+
+[run]
+output_folder = "Rapport 2025"
+n_workers = 4                       # Optional: number of departments reported in parallel.
+seed = 42                           # Optional: seed for the bootstrap confidence intervals.
+ci = true                           # Optional: include confidence intervals (default true).
+
+[[department]]
+name = "Kardiologi"
+rooms = ["KRH_XA3", "KRH_XA6", "KRH_XA7", "KRH_XA8"]
+mapping = "mapping_dict_PCI.get_PCI_mapping_dict"
+
+[department.procedures]             # Procedure = y_max of the plot.
+Koronarangiografi = 50
+PCI = 100
+TAVI = 75
+
+The mapping is the name of a get_*_mapping_dict() function in xa_dose_analysis.mapping_dicts,
+or 'package.module:function' for a mapping dictionary function in another module.
+"""
+
+import argparse
+import contextlib
+import importlib
+import os
+import sys
+import tomllib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from xa_dose_analysis import dt_ids7_export_module as bh_utils
+from xa_dose_analysis import mapping_module as bh_map
+from xa_dose_analysis import plot_module as bh_plot
+from xa_dose_analysis import reporting_module as bh_report
+from xa_dose_analysis import store_module as bh_store
+
+def _load_job_file(job_file):
+    """
+    This function reads the job file, and checks that the required settings are there.
+    Returns the job as a dictionary, or None (with a warning) if the job file is not valid.
+    """
+    with open(job_file, 'rb') as f:
+        job = tomllib.load(f)
+
+    if 'data' not in job or not {'ids7_folder', 'dt_folder'} <= set(job['data']):
+        print('WARNING: The job file must have a [data] table with ids7_folder and dt_folder.')
+        return
+    if not job.get('department'):
+        print('WARNING: The job file must have at least one [[department]].')
+        return
+    for department in job['department']:
+        missing = [key for key in ['name', 'rooms', 'mapping', 'procedures'] if key not in department]
+        if missing:
+            print('WARNING: The department ' + str(department.get('name')) + ' is missing: ' + ', '.join(missing))
+            return
+    job.setdefault('run', {})
+    return job
+
+def _get_mapping_dict(mapping):
+    """
+    This function returns the mapping dictionary from the name of its function:
+    'mapping_dict_PCI.get_PCI_mapping_dict' for the mapping dictionaries in xa_dose_analysis.mapping_dicts,
+    or 'package.module:function' for other modules.
+    """
+    if ':' in mapping:
+        module_name, function_name = mapping.split(':')
+    else:
+        module_name, function_name = mapping.rsplit('.', 1)
+        module_name = 'xa_dose_analysis.mapping_dicts.' + module_name
+    return getattr(importlib.import_module(module_name), function_name)()
+
+def load_merged_data(data_settings, verbose=True):
+    """
+    This function imports, cleans and merges the IDS7 and DoseTrack exports given in the [data] table of the job file.
+    If store_folder is given, the incremental store is updated and used instead.
+    """
+    n_workers = data_settings.get('n_workers', 1)
+    cache_folder = data_settings.get('cache_folder')
+    review_file = data_settings.get('review_file')
+
+    if 'store_folder' in data_settings:
+        return bh_store.update_merged_store(data_settings['store_folder'], data_settings['ids7_folder'],
+                                            data_settings['dt_folder'], n_workers=n_workers, cache_folder=cache_folder,
+                                            verbose=verbose, review_file=review_file)
+
+    df_ids7 = bh_utils.import_excel_files_to_dataframe(data_settings['ids7_folder'], n_workers=n_workers,
+                                                       cache_folder=cache_folder)
+    df_dt = bh_utils.import_excel_files_to_dataframe(data_settings['dt_folder'], n_workers=n_workers,
+                                                     cache_folder=cache_folder)
+    df_ids7 = bh_utils.run_all_cleanup_filters_and_checks(df_ids7, df_dt, verbose=verbose, review_file=review_file)
+    return bh_utils.merge_ids7_dt(df_ids7, df_dt, verbose=verbose)
+
+def _report_department(data, department, output_folder, ci=True, seed=None):
+    """
+    This function reports one department: maps the data, and plots and prints the summaries of each procedure, as the
+    run_analysis function in the notebooks. Everything is written to the folder of the department.
+    Returns the name of the department and the number of procedures reported.
+    Procedures without data are skipped with a warning, so that one procedure does not stop the whole job.
+    """
+    plt, _ = bh_plot._import_plotting_libraries()
+    folder = Path(output_folder) / department['name']
+    os.makedirs(folder, exist_ok=True)
+    cwd = os.getcwd()
+    # plot_representative_dose saves the figures in the Figures folder of the working directory:
+    os.chdir(folder)
+    try:
+        with open('report.txt', 'w', encoding='utf-8') as report, contextlib.redirect_stdout(report):
+            print('Department: ' + department['name'])
+            print('Rooms: ' + ', '.join(department['rooms']))
+            print('\n')
+            data = bh_map.map_procedures(data, _get_mapping_dict(department['mapping']), verbose=True)
+            if data is None:
+                return department['name'], 0
+
+            summaries = []
+            reported = []
+            for procedure, y_max in department['procedures'].items():
+                data_procedure = data[data['Mapped Procedures'] == procedure]
+                if data_procedure.empty:
+                    print('WARNING: No procedures are mapped to ' + procedure + ', it is not reported.')
+                    print('\n')
+                    continue
+                fig, summary, summary_per_lab = bh_plot._plot_representative_dose(data_procedure, procedure, y_max,
+                                                                                  save=True, seed=seed)
+                plt.close(fig)
+                print('\n')
+                time_summary = bh_report._report_exposure_time_all(data_procedure, ci, seed=seed)
+                print('\n')
+                time_summary_per_lab = bh_report._report_exposure_time_per_lab(data_procedure, ci, seed=seed)
+                print('\n')
+                print('###############################################')
+                print('\n')
+                for table in [summary, summary_per_lab, time_summary, time_summary_per_lab]:
+                    summaries.append(table.assign(Procedure=procedure))
+                reported.append(procedure)
+
+        if summaries:
+            pd.concat(summaries, ignore_index=True).to_csv('summary.csv', index=False)
+    finally:
+        os.chdir(cwd)
+    return department['name'], len(reported)
+
+def run_job(job, n_workers=None):
+    """
+    This function runs all the departments in the job: the data is loaded and merged once,
+    and the departments are reported in parallel worker processes (n_workers from the [run] table if not given).
+    Returns the name and the number of reported procedures of each department, or None (with a warning) if the data
+    could not be loaded and merged.
+    """
+    settings = job['run']
+    output_folder = Path(settings.get('output_folder', 'Reports')).resolve()
+    os.makedirs(output_folder, exist_ok=True)
+    if n_workers is None:
+        n_workers = settings.get('n_workers', 1)
+    n_workers = min(n_workers or os.cpu_count() or 1, len(job['department']))
+    ci = settings.get('ci', True)
+    seed = settings.get('seed')
+
+    data = load_merged_data(job['data'])
+    # merge_ids7_dt returns False, and update_merged_store returns None, if the data could not be merged:
+    if not isinstance(data, pd.DataFrame):
+        print('WARNING: No merged data, the report is stopped.')
+        return
+
+    # Only send the rows of the rooms of each department to the workers:
+    tasks = [(data[data['Modality Room'].isin(department['rooms'])], department) for department in job['department']]
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=bh_plot._use_agg_backend) as executor:
+            futures = [executor.submit(_report_department, data_department, department, output_folder, ci, seed)
+                       for data_department, department in tasks]
+            results = [future.result() for future in futures]
+    else:
+        # The figures are rendered with the Agg backend here too, and the backend of the caller is restored after:
+        backend = bh_plot._use_agg_backend()
+        try:
+            results = [_report_department(data_department, department, output_folder, ci, seed)
+                       for data_department, department in tasks]
+        finally:
+            import matplotlib
+            matplotlib.use(backend)
+
+    for name, n_procedures in results:
+        print('Reported ' + str(n_procedures) + ' procedures for ' + name + ' in: ' + str(output_folder / name))
+    return results
+
+def main(argv=None):
+    """
+    The entry point of the xa-dose-report command.
+    """
+    parser = argparse.ArgumentParser(prog='xa-dose-report',
+                                     description='Run the dose reports of all the departments in a job file.')
+    parser.add_argument('job_file', help='TOML file with the data folders, the departments and their procedures.')
+    parser.add_argument('--n-workers', type=int, help='Number of departments reported in parallel.')
+    args = parser.parse_args(argv)
+
+    job = _load_job_file(args.job_file)
+    if job is None:
+        sys.exit(1)
+    if run_job(job, n_workers=args.n_workers) is None:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,8 @@ Pasient:    This is required for the functions aimed at detecting and correcting
 These functions require an export of the DoseTrack data with the column titles in the first row.
 It is usually a good idea right after the excel export to filter the excel file by using only the rows with ordinal = 1.
 This will greatly reduce the size of the excel file while still maintaining the procedure level data.
-For Acquisition level data, another python module should be created.
+Alternatively, exposure_module.aggregate_exposure_files reads the unfiltered exposure level export one file at a time
+and returns the procedure level rows, so the same export can be used for the angle analysis in exposure_module.
 
 The following columns are required in the DoseTrack data:
 Accession Number
@@ -30,6 +31,17 @@ Accession Number
 
 The following functions are included in this module:
 
+-------------------------------- Importing the data: --------------------------------
+import_excel_files_to_dataframe:    Imports all Excel files in a folder tree into one DataFrame, with a Source_File column.
+                                    Pass n_workers > 1 (or None for all cores) to read the files in parallel.
+                                    Pass cache_folder to store each parsed workbook as a Parquet file, so that
+                                    unchanged files are not parsed again on the next import.
+                                    Pass columns, accession_numbers and/or row_filter to keep only a subset of
+                                    each file while reading, e.g. the exposures of one procedure.
+
+delete_import_cache:                Deletes all the cached Parquet files in a cache folder.
+-------------------------------------------------------------------------------------
+
 -------------------------------- Filtering the data: --------------------------------
 remove_unnecessary_columns: Which removes the a few unnessecary columns from the IDS7 dataframe:
                             Prioritet- og lesemerkeikon, Lagt til i demonstrasjon-ikon og Status.
@@ -39,6 +51,11 @@ filter_NaT:                 Removes rows with NaT in the column 'Bestilt dato og
 filter_cancelled:           Removes rows where the procedures have been cancelled: 'Avbrutt' == 'Avbrutt'.
 
 filter_phantom_etc:         Removes rows representing non-human subjects: 'Henvisningskategori (RIS)' == 'X Fantom/objekt/dyr/test'.
+
+CleanupPipeline:            Collects the filters as boolean masks and column drops, and materializes the filtered dataframe once.
+                            The summary method returns the number of rows removed by each step.
+
+build_cleanup_pipeline:     Builds the CleanupPipeline with all the filters above and check_accession_format.
 -------------------------------------------------------------------------------------
 
 -------------------------------- Checking the data: --------------------------------
@@ -58,12 +75,14 @@ check_patents_with_multiple_bookings_on_same_time_with_different_accession:
                             
                             This function is used to report whether there are patients with multiple bookings on the
                             same time with different accession numbers. This can be used to explore the extent of possibly duplicates.
+                            The bookings are returned as a dataframe, and printed if verbose is True.
 
 check_patents_with_multiple_bookings_on_same_day_with_different_accession:
 
                             This function is used to report whether there are patients with multiple bookings on the
                             same day (but not on the same time). This can be used to explore the extent of possibly duplicates with 
                             slightly different booking times.
+                            The bookings are returned as a dataframe, and printed if verbose is True.
 
 
 overwrite_duplicated_accession_numbers:     For a few patients having a procedure, there has been created two accession numbers in IDS7.
@@ -73,8 +92,15 @@ overwrite_duplicated_accession_numbers:     For a few patients having a procedur
                                             This function will check if there are two accession numbers for the same patient at the same time.
                                             If only one of these are in dosetrack while the rest is not, 
                                             the accession number will be overwritten by the accession number used by dosetrack.
+                                            Ambiguous cases are queued in a review table, which can be written to a csv file.
+
+get_accession_number_review_table:          Returns the review table of ambiguous accession numbers, with an empty column
+                                            'Valgt Henvisnings-ID' to be filled in offline.
+
+apply_accession_number_review:              Applies a filled in review table (dataframe or csv file) to the IDS7 data.
 
 run_all_cleanup_filters_and_checks:         This function runs all the functions in this module in the correct order for conveniance.
+                                            The filters are applied in one step through the CleanupPipeline.
 -------------------------------------------------------------------------------------
 
 --------- Funciton for merging IDS7 and DoseTrack dataframes: ----------
@@ -84,9 +110,14 @@ merge_ids7_dt:              This function merged the data from IDS7 and DoseTrac
                             In this function there is a lost of optional columns for both dataframes to be included in the merged dataframe.
                             The users should add parameters to the optional lists if they would like them added to the merged dataframe.
 
+compact_dataframe:          Reduces the memory usage of a dataframe, by converting the low-cardinality text columns to categoricals
+                            and downcasting the integer columns (and the float columns, if downcast_floats=True).
+                            Pass compact=True to merge_ids7_dt to compact the merged data.
+
 --------------- Function for exporting data: ----------
 export_examination_codes_to_text_file:      This function generates a txt file with one line for each combination of aggregated
                                             examination descriptions in a folder called Reports.
+                                            Pass combined_file to also write the codes of all the labs to one CSV or Parquet table.
                                             These lists can be printed and shown to the department to promote discussion on which
                                             procedures are important, and which should not be reported on.
                         
@@ -114,6 +145,11 @@ import numpy as np
 import re
 import os
 import glob
+import hashlib
+import importlib.util
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 # Utility functions:
 def _concatenate_protocol(series):
@@ -123,6 +159,30 @@ def _concatenate_protocol(series):
     sort = series.sort_values()
     return ', '.join(sort.astype(str))
 
+def _concatenate_protocols(df, group_column, column='Beskrivelse'):
+    """
+    This function concatenates the protocol information of every group into a single string, giving the same strings
+    as _concatenate_protocol, but without calling a function per group:
+    the descriptions are ranked once with factorize, the rows are sorted once by group and rank,
+    and the sorted descriptions of each group are joined.
+    The column must be a text column without missing values.
+    Returns a list with one string per group, in the order of df.groupby(group_column).
+    """
+    group = df.groupby(group_column).ngroup().to_numpy()
+    ranks, descriptions = pd.factorize(df[column], sort=True)
+    descriptions = np.asarray(descriptions.astype(str), dtype=object)
+
+    order = np.lexsort((ranks, group))
+    # Rows without an accession number are not in any group:
+    order = order[group[order] >= 0]
+    if len(order) == 0:
+        return []
+    group = group[order]
+    values = descriptions[ranks[order]].tolist()
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    return [', '.join(values[start:end]) for start, end in zip(starts, ends)]
+
 def _check_for_column(data, source, column_name):
     """
     This function checks if a column is in the dataframe.
@@ -182,37 +242,240 @@ def _add_optional_columns(data, agg_dict, agg_dict_optional, source, verbose=Fal
     return agg_dict
 
 
-def import_excel_files_to_dataframe(root_folder):
+def _cache_file_path(file_path, cache_folder):
+    """
+    Returns the path of the cached Parquet file for an Excel file.
+    The name is built from a hash of the full path together with the size and modification time of the file,
+    so a changed file gets a new cache entry and is parsed again.
+    """
+    stat = file_path.stat()
+    path_key = hashlib.sha1(str(file_path.resolve()).encode('utf-8')).hexdigest()
+    return Path(cache_folder) / f'{path_key}_{stat.st_size}_{stat.st_mtime_ns}.parquet'
+
+def _select_imported_rows(df, columns, accession_numbers, accession_column, row_filter):
+    """
+    Applies the accession number filter, the row filter and the column selection to one imported file.
+    """
+    if accession_numbers is not None:
+        df = df[df[accession_column].isin(accession_numbers)]
+    if row_filter is not None:
+        df = df[row_filter(df)]
+    if columns is not None:
+        df = df[columns]
+    return df
+
+def _read_excel_file(file_path, cache_folder=None, columns=None, accession_numbers=None,
+                     accession_column='Accession Number', row_filter=None, root_folder=None):
+    """
+    Reads a single Excel file into a DataFrame and adds the Source_File column.
+    If a cache folder is given, the parsed workbook is read from (or stored to) a Parquet file in that folder.
+    If columns, accession_numbers or row_filter are given, only the selected columns and rows are kept.
+    If root_folder is given, Source_File is the path relative to the root folder instead of the file name.
+    This function is kept at module level so that it can be sent to the worker processes.
+    Returns the DataFrame and None, or None and the exception if the file could not be read.
+    """
+    # The accession column must be read to filter on it, even if it is not one of the selected columns:
+    read_columns = columns
+    if columns is not None and accession_numbers is not None and accession_column not in columns:
+        read_columns = list(columns) + [accession_column]
+
+    try:
+        if cache_folder is None:
+            df = pd.read_excel(file_path, usecols=read_columns)
+        else:
+            cache_file = _cache_file_path(file_path, cache_folder)
+            if cache_file.exists():
+                df = pd.read_parquet(cache_file, columns=read_columns)
+            else:
+                # The full workbook is cached, so the same cache can be used for any column selection:
+                df = pd.read_excel(file_path)
+                # Remove cache entries from earlier versions of the same file:
+                for old_cache_file in cache_file.parent.glob(cache_file.name.split('_')[0] + '_*.parquet'):
+                    old_cache_file.unlink()
+                try:
+                    df.to_parquet(cache_file, index=False)
+                except Exception as e:
+                    cache_file.unlink(missing_ok=True)
+                    print(f"WARNING: Could not cache {file_path}, it will be read from Excel next time: {e}")
+                if read_columns is not None:
+                    df = df[read_columns]
+        df = _select_imported_rows(df, columns, accession_numbers, accession_column, row_filter)
+        # Add a column to track the source file:
+        df['Source_File'] = file_path.name if root_folder is None else file_path.relative_to(root_folder).as_posix()
+        return df, None
+    except Exception as e:
+        return None, e
+
+def import_excel_files_to_dataframe(root_folder, n_workers=1, cache_folder=None, columns=None,
+                                    accession_numbers=None, accession_column='Accession Number', row_filter=None):
     """
     Imports all Excel files from a folder tree into one DataFrame.
+    The files are read in sorted order, so the row order is the same regardless of the number of workers.
+
+    If a cache folder is given, each parsed workbook is stored there as a Parquet file (requires pyarrow).
+    The cache is keyed by the path, size and modification time of the Excel file, so new or changed files
+    are parsed again automatically, while unchanged files are read directly from the cache.
+
+    The columns, accession_numbers and row_filter arguments are applied to each file as it is read,
+    so only the selected subset of every file is held in memory. This is useful for the large exposure level
+    DoseTrack exports, e.g. when only the exposures of one procedure are needed:
+    import_excel_files_to_dataframe(root_folder, columns=['Accession Number', 'Air Kerma (mGy)'], 
+                                    accession_numbers=procedure_data['Accession Number'].unique())
     
     Args:
         root_folder (str): Path to the root folder containing Excel files.
+        n_workers (int): Number of worker processes used to read the files.
+                         1 (default) reads the files one at a time, None uses all available cores.
+        cache_folder (str): Path to a folder for the Parquet cache. None (default) disables the cache.
+        columns (list): Columns to keep. None (default) keeps all columns.
+        accession_numbers (iterable): Only keep rows where the accession_column is in this collection.
+        accession_column (str): The column used by the accession_numbers filter (default 'Accession Number',
+                                use 'Henvisnings-ID' for IDS7 exports).
+        row_filter (callable): A function that takes the DataFrame of one file and returns a boolean mask 
+                               of the rows to keep. It only sees the selected columns (and the accession column).
+                               With n_workers > 1 it must be a module level function, not a lambda.
         
     Returns:
         pd.DataFrame: Combined DataFrame with data from all Excel files.
     """
-    from pathlib import Path
+    # Find all Excel files recursively:
+    file_paths = sorted(Path(root_folder).rglob("*.xlsx"))
+
+    return _import_excel_files(file_paths, n_workers=n_workers, cache_folder=cache_folder, columns=columns,
+                               accession_numbers=accession_numbers, accession_column=accession_column, row_filter=row_filter)
+
+def _import_excel_files(file_paths, n_workers=1, cache_folder=None, columns=None, accession_numbers=None,
+                        accession_column='Accession Number', row_filter=None, root_folder=None):
+    """
+    Imports a list of Excel files into one DataFrame, in the order of the list. 
+    See import_excel_files_to_dataframe for the arguments.
+    """
+    if cache_folder is not None:
+        if importlib.util.find_spec('pyarrow') is None:
+            print('WARNING: pyarrow is not installed, so the Excel files cannot be cached.')
+            print('Install pyarrow to enable the cache. The files will be read without it.')
+            print('\n')
+            cache_folder = None
+        else:
+            os.makedirs(cache_folder, exist_ok=True)
+
+    # A set makes the per file isin-filter fast, and is sent to the worker processes only once per file:
+    if accession_numbers is not None:
+        accession_numbers = set(accession_numbers)
+
+    read_file = partial(_read_excel_file, cache_folder=cache_folder, columns=columns, accession_numbers=accession_numbers,
+                        accession_column=accession_column, row_filter=row_filter, root_folder=root_folder)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(file_paths))
+
     # List to store individual DataFrames
     dataframes = []
 
-    # Traverse through the folder tree
-    for file_path in Path(root_folder).rglob("*.xlsx"):  # Find all Excel files recursively
-        try:
-            # Read Excel file into a DataFrame
+    if n_workers > 1:
+        for file_path in file_paths:
             print(f"Reading {file_path}...")
-            df = pd.read_excel(file_path)
-            df['Source_File'] = file_path.name  # Add a column to track the source file
-            dataframes.append(df)  # Append to list
-        except Exception as e:
-            print(f"Error reading {file_path}: {e}")
+        # Read the files in parallel, map returns the results in the same order as the file list:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = executor.map(read_file, file_paths)
+            for file_path, (df, error) in zip(file_paths, results):
+                if error is not None:
+                    print(f"Error reading {file_path}: {error}")
+                else:
+                    dataframes.append(df)  # Append to list
+    else:
+        for file_path in file_paths:
+            print(f"Reading {file_path}...")
+            df, error = read_file(file_path)
+            if error is not None:
+                print(f"Error reading {file_path}: {error}")
+            else:
+                dataframes.append(df)  # Append to list
 
     # Combine all DataFrames into one
     combined_df = pd.concat(dataframes, ignore_index=True)
     return combined_df
 
+def delete_import_cache(cache_folder, delete_folder=False):
+    """
+    This function deletes all the cached Parquet files in the cache folder.
+    If delete_folder is True, the cache folder is also deleted.
+    """
+    for cache_file in glob.glob(os.path.join(cache_folder, '*.parquet')):
+        os.remove(cache_file)
+
+    if delete_folder:
+        if os.path.exists(cache_folder):
+            os.rmdir(cache_folder)
+    return
+
 
 # Functions for filtering the IDS7 dataframe:
+_UNNECESSARY_COLUMNS = ['Prioritet- og lesemerkeikon', 'Lagt til i demonstrasjon-ikon', 'Status']
+
+def _get_unnecessary_columns(df_ids7):
+    """
+    This function returns the unnecessary columns that exist in the IDS7 dataframe.
+    """
+    return [column for column in _UNNECESSARY_COLUMNS if column in df_ids7.columns]
+
+def _get_NaT_mask(df_ids7):
+    """
+    This function returns a boolean mask of the rows to keep: the rows without NaT in the column 'Bestilt dato og tidspunkt'.
+    Returns None if the column does not exist.
+    """
+    # Check whether the column 'Bestilt dato og tidspunkt' exists:
+    if not _check_for_column(df_ids7, 'IDS7', 'Bestilt dato og tidspunkt'):
+        print('Without this column, we cannot remove rows with NaT in the column "Bestilt dato og tidspunkt".')
+        print('\n')
+        return None
+    return df_ids7['Bestilt dato og tidspunkt'].notnull()
+
+def _get_cancelled_mask(df_ids7):
+    """
+    This function returns a boolean mask of the rows to keep: the rows where the procedures have not been cancelled.
+    Returns None if the column 'Avbrutt' does not exist.
+    """
+    # Check whether the column 'Avbrutt' exists:
+    if not _check_for_column(df_ids7, 'IDS7', 'Avbrutt'):
+        print('Without this column, we cannot remove cancelled procedures.')
+        print('\n')
+        return None
+    return df_ids7['Avbrutt'] != 'Avbrutt'
+
+def _get_phantom_mask(df_ids7):
+    """
+    This function returns a boolean mask of the rows to keep: the rows representing human subjects.
+    Returns None if the column 'Henvisningskategori (RIS)' does not exist.
+    """
+    # Check whether the column 'Henvisningskategori (RIS)' exists:
+    if not _check_for_column(df_ids7, 'IDS7', 'Henvisningskategori (RIS)'):
+        print('Without this column, we cannot remove non-human subjects, such as phantoms, animals or other test acquisitions.')
+        print('This could potentially lead to reduced data quality.')
+        print('\n')
+        return None
+    return df_ids7['Henvisningskategori (RIS)'] != 'X Fantom/objekt/dyr/test'
+
+def _get_accession_format_mask(df_ids7):
+    """
+    This function returns a boolean mask of the rows to keep: the rows where the accession number has a correct start and length.
+    Returns None if the column 'Henvisnings-ID' does not exist.
+    """
+    # Check whether the column 'Henvisnings-ID' exists:
+    if not _check_for_column(df_ids7, 'IDS7', 'Henvisnings-ID'):
+        print('Without this column, we cannot check the accession number format, or merge IDS7 with DoseTrack data.')
+        print('\n')
+        return None
+    
+    valid_formats = r'^(NORRH|NRRH|NKRH|NIRH|NNRH|NRUL|NKUL|NRRA|NRAK|NLVO|MUAH_)'
+    patten = re.compile(valid_formats)
+
+    # HenvinsingsID must have the correct start and length of 16 characters (MUAH_ numbers have 12):
+    is_valid_format = (df_ids7['Henvisnings-ID'].str.match(patten)) &  \
+                      ((df_ids7['Henvisnings-ID'].str.len() == 16) | (df_ids7['Henvisnings-ID'].str.len() == 12))
+    return is_valid_format.fillna(False).astype(bool)
+
 def remove_unnecessary_columns(df_ids7, verbose=False):
     """
     This function removes columns that are automatically included in the export but not needed for analysis, these are:
@@ -220,20 +483,10 @@ def remove_unnecessary_columns(df_ids7, verbose=False):
     Lagt til i demonstrasjon-ikon
     Status
     """
-    if 'Prioritet- og lesemerkeikon' in df_ids7.columns:
-        if verbose:
-            print('Dropping unnecessary column: Prioritet- og lesemerkeikon')
-        df_ids7.drop('Prioritet- og lesemerkeikon', axis=1, inplace=True)
-
-    if 'Lagt til i demonstrasjon-ikon' in df_ids7.columns:
-        if verbose:
-            print('Dropping unnecessary column: Lagt til i demonstrasjon-ikon')
-        df_ids7.drop('Lagt til i demonstrasjon-ikon', axis=1, inplace=True)
-
-    if 'Status' in df_ids7.columns:
+    for column in _get_unnecessary_columns(df_ids7):
         if verbose:
-            print('Dropping unnecessary column: Status')
-        df_ids7.drop('Status', axis=1, inplace=True)
+            print('Dropping unnecessary column: ' + column)
+        df_ids7.drop(column, axis=1, inplace=True)
     
     return df_ids7
 
@@ -242,9 +495,8 @@ def filter_NaT(df_ids7, verbose=False):
     This function removes row with NaT in the column 'Bestilt dato og tidspunkt'
     """
     # Check whether the column 'Bestilt dato og tidspunkt' exists:
-    if not _check_for_column(df_ids7, 'IDS7', 'Bestilt dato og tidspunkt'):
-        print('Without this column, we cannot remove rows with NaT in the column "Bestilt dato og tidspunkt".')
-        print('\n')
+    keep = _get_NaT_mask(df_ids7)
+    if keep is None:
         return df_ids7
     
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
@@ -252,9 +504,9 @@ def filter_NaT(df_ids7, verbose=False):
         return df_ids7
     
     if verbose:
-        print('Number of rows with NaT in the column "Bestilt dato og tidspunkt": {}'.format(sum(df_ids7['Bestilt dato og tidspunkt'].isnull())))
+        print('Number of rows with NaT in the column "Bestilt dato og tidspunkt": {}'.format(sum(~keep)))
 
-    df_ids7 = df_ids7[df_ids7['Bestilt dato og tidspunkt'].notnull()]
+    df_ids7 = df_ids7[keep]
     return df_ids7
 
 def filter_cancelled(df_ids7, verbose=False):
@@ -266,16 +518,14 @@ def filter_cancelled(df_ids7, verbose=False):
         return df_ids7
 
     # Check whether the column 'Avbrutt' exists:
-    if not _check_for_column(df_ids7, 'IDS7', 'Avbrutt'):
-        print('Without this column, we cannot remove cancelled procedures.')
-        print('\n')
+    keep = _get_cancelled_mask(df_ids7)
+    if keep is None:
         return df_ids7
     
-    if _check_for_column(df_ids7, 'IDS7', 'Avbrutt'):
-        if verbose:
-            print('Number of cancelled procedures: {}'.format(sum(df_ids7['Avbrutt'] == 'Avbrutt')))
-        df_ids7 = df_ids7[df_ids7['Avbrutt'] != 'Avbrutt']
-        return df_ids7
+    if verbose:
+        print('Number of cancelled procedures: {}'.format(sum(~keep)))
+    df_ids7 = df_ids7[keep]
+    return df_ids7
 
 def filter_phantom_etc(df_ids7, verbose=False):
     """ 
@@ -286,25 +536,112 @@ def filter_phantom_etc(df_ids7, verbose=False):
         return df_ids7
 
     # Check whether the column 'Henvisningskategori (RIS)' exists:
-    if not _check_for_column(df_ids7, 'IDS7', 'Henvisningskategori (RIS)'):
-        print('Without this column, we cannot remove non-human subjects, such as phantoms, animals or other test acquisitions.')
-        print('This could potentially lead to reduced data quality.')
-        print('\n')
+    keep = _get_phantom_mask(df_ids7)
+    if keep is None:
         return df_ids7
     
     if verbose:
-        print('Number of non-human subjects: {}'.format(sum(df_ids7['Henvisningskategori (RIS)'] == 'X Fantom/objekt/dyr/test')))
+        print('Number of non-human subjects: {}'.format(sum(~keep)))
 
-    df_ids7 = df_ids7[df_ids7['Henvisningskategori (RIS)'] != 'X Fantom/objekt/dyr/test']
+    df_ids7 = df_ids7[keep]
     return df_ids7
 
+class CleanupPipeline:
+    """
+    This class collects the cleanup steps for the IDS7 dataframe as boolean masks of the rows to keep and lists of 
+    columns to drop, and materializes the filtered dataframe once, when run is called.
+    All the masks are computed on the original dataframe, and each step only removes rows that were kept by the 
+    previous steps, so the row counts in the summary are the same as when the steps are run one after another.
+
+    Example:
+    pipeline = CleanupPipeline(df_ids7)
+    pipeline.drop_columns('remove_unnecessary_columns', ['Status'])
+    pipeline.filter_rows('filter_cancelled', df_ids7['Avbrutt'] != 'Avbrutt')
+    df_ids7 = pipeline.run()
+    print(pipeline.summary())
+    """
+    def __init__(self, df_ids7):
+        self.df_ids7 = df_ids7
+        self.steps = []
+
+    def drop_columns(self, name, columns):
+        """
+        Adds a step that drops the given columns.
+        """
+        self.steps.append((name, None, list(columns)))
+        return self
+
+    def filter_rows(self, name, keep):
+        """
+        Adds a step that keeps the rows where the boolean mask keep is True.
+        If keep is None (e.g. because a required column is missing), no rows are removed by the step.
+        """
+        self.steps.append((name, keep, []))
+        return self
+
+    def _combined_mask(self):
+        """
+        Returns the combined mask of all the steps, and the summary rows of the steps.
+        """
+        keep_all = np.ones(len(self.df_ids7), dtype=bool)
+        summary = []
+        for name, keep, columns in self.steps:
+            rows_in = int(keep_all.sum())
+            if keep is not None:
+                keep_all &= np.asarray(keep, dtype=bool)
+            summary.append({'Step': name,
+                            'Rows in': rows_in,
+                            'Rows removed': rows_in - int(keep_all.sum()),
+                            'Rows out': int(keep_all.sum()),
+                            'Columns dropped': ', '.join(columns)})
+        return keep_all, summary
+
+    def summary(self):
+        """
+        Returns a dataframe with the number of rows in, removed and out, and the columns dropped, for each step.
+        """
+        _, summary = self._combined_mask()
+        return pd.DataFrame(summary, columns=['Step', 'Rows in', 'Rows removed', 'Rows out', 'Columns dropped'])
+
+    def run(self):
+        """
+        Materializes the filtered dataframe with a single selection of rows and columns.
+        """
+        keep_all, _ = self._combined_mask()
+        dropped = {column for _, _, columns in self.steps for column in columns}
+        columns = [column for column in self.df_ids7.columns if column not in dropped]
+        return self.df_ids7.loc[keep_all, columns]
+
+def build_cleanup_pipeline(df_ids7, verbose=False):
+    """
+    This function builds the CleanupPipeline with the steps remove_unnecessary_columns, filter_NaT, filter_cancelled,
+    filter_phantom_etc and check_accession_format. If verbose is True, the invalid accession numbers are printed.
+    """
+    pipeline = CleanupPipeline(df_ids7)
+    pipeline.drop_columns('remove_unnecessary_columns', _get_unnecessary_columns(df_ids7))
+    pipeline.filter_rows('filter_NaT', _get_NaT_mask(df_ids7))
+    pipeline.filter_rows('filter_cancelled', _get_cancelled_mask(df_ids7))
+    pipeline.filter_rows('filter_phantom_etc', _get_phantom_mask(df_ids7))
+    is_valid_format = _get_accession_format_mask(df_ids7)
+
+    if verbose and is_valid_format is not None:
+        # Print the invalid accession numbers of the rows that are not removed by the previous steps:
+        keep_all, _ = pipeline._combined_mask()
+        invalid = keep_all & ~is_valid_format.to_numpy()
+        if invalid.sum() > 0:
+            print('Invalid accession numbers:')
+            print(df_ids7.loc[invalid, 'Henvisnings-ID'])
+
+    pipeline.filter_rows('check_accession_format', is_valid_format)
+    return pipeline
+
 # Functions for checking the IDS7 and DoseTrack dataframes:
 def check_accession_format(df_ids7, verbose=False):
     """
     This function checks if the accession number has a correct start and length.
     The currently allowed accession numbers are:
-    (NORRH|NRRH|NRAK|NIRH|NKRH|NKUL|NNRH|NRRA|NRUL)
-    Additionally the length of the accession number must be 16 characters.
+    (NORRH|NRRH|NKRH|NIRH|NNRH|NRUL|NKUL|NRRA|NRAK|NLVO|MUAH_)
+    Additionally the length of the accession number must be 16 characters (12 for MUAH_).
     If verbose is True, the function will print the number of invalid accession numbers
     and the invalid accession numbers.
     """
@@ -313,17 +650,9 @@ def check_accession_format(df_ids7, verbose=False):
         return df_ids7
 
     # Check whether the column 'Henvisnings-ID' exists:
-    if not _check_for_column(df_ids7, 'IDS7', 'Henvisnings-ID'):
-        print('Without this column, we cannot check the accession number format, or merge IDS7 with DoseTrack data.')
-        print('\n')
+    is_valid_format = _get_accession_format_mask(df_ids7)
+    if is_valid_format is None:
         return df_ids7
-    
-    valid_formats = r'^(NORRH|NRRH|NKRH|NIRH|NNRH|NRUL|NKUL|NRRA|NRAK|NLVO|MUAH_)'
-    patten = re.compile(valid_formats)
-
-    # HenvinsingsID must have the correct start and length of 16 characters (MUAH_ numbers have 12):
-    is_valid_format = (df_ids7['Henvisnings-ID'].str.match(patten)) &  \
-                      ((df_ids7['Henvisnings-ID'].str.len() == 16) | (df_ids7['Henvisnings-ID'].str.len() == 12))
 
     if verbose:
         print('Number of rows with invalid accession number: {}'.format(sum(~is_valid_format)))
@@ -418,7 +747,14 @@ def check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=False):
     return df_dt
 
 # Functions for attempting to detect and correct errrors in the datasets:
-def check_patents_with_multiple_bookings_on_same_time_with_different_accession(df_ids7):
+def _get_bookings(df_ids7):
+    """
+    This function returns the unique (Pasient, Bestilt dato og tidspunkt, Henvisnings-ID) combinations in the IDS7 data.
+    Rows with missing values in any of these columns are ignored.
+    """
+    return df_ids7[['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID']].dropna().drop_duplicates()
+
+def check_patents_with_multiple_bookings_on_same_time_with_different_accession(df_ids7, verbose=True):
     """
     This function is used to report whether there are patients with multiple bookings on the
     same time with different accession numbers. This is useful in order to check whether there is a large 
@@ -427,6 +763,8 @@ def check_patents_with_multiple_bookings_on_same_time_with_different_accession(d
     Many of these were cancelled procedusres, and should be removed in data filtration.
     Others were infact the same procedure. These shoudl have their accession number changed to the one
     reported in the dosetrack data.
+    All the (patient, time) groups are found in one groupby over the data, and returned as a dataframe with 
+    one row per accession number in each group. If verbose is True, the groups are also printed.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -451,28 +789,21 @@ def check_patents_with_multiple_bookings_on_same_time_with_different_accession(d
         print('\n')
         return
     
-    # Make a list of all patients with multiple bookings on the same day with different accession numbers:
-    patient_list = df_ids7['Pasient'].drop_duplicates()
-    for patient in patient_list:
-        # Get the booking times for this patient:
-        booking_times = df_ids7[df_ids7['Pasient'] == patient]['Bestilt dato og tidspunkt']
-        # Sort the booking times:
-        booking_times = booking_times.sort_values()
-        # if there is more than one booking:
-        if len(booking_times) > 1:
-            # loop through all bookings:
-            for i in range(len(booking_times)-1):
-                # Check if the booking times are on the same day but different time with different accesstion numbers:
-                if (booking_times.iloc[i] == booking_times.iloc[i+1]):
-                    # Get the accession numbers:
-                    acc_no = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == booking_times.iloc[i])]['Henvisnings-ID'].drop_duplicates()
-                    # Check if there are multiple accession numbers:
-                    if len(acc_no) > 1:
-                        print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(booking_times.iloc[i]) + ':')
-                        print(acc_no)
-                        print('')
-
-def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df_ids7):
+    # Find all the (patient, time) groups with more than one accession number:
+    bookings = _get_bookings(df_ids7)
+    n_accessions = bookings.groupby(['Pasient', 'Bestilt dato og tidspunkt'])['Henvisnings-ID'].transform('size')
+    duplicates = bookings[n_accessions > 1].sort_values(by=['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID'])
+    duplicates = duplicates.reset_index(drop=True)
+
+    if verbose:
+        for (patient, time), group in duplicates.groupby(['Pasient', 'Bestilt dato og tidspunkt'], sort=False):
+            print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(time) + ':')
+            print(group['Henvisnings-ID'].to_string(index=False))
+            print('')
+
+    return duplicates
+
+def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df_ids7, verbose=True):
     """
     This function is used to report whether there are patients with multiple bookings on the
     same day (not on the same time, as they are included in the data curation) with
@@ -480,6 +811,9 @@ def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df
     number of patients with multiple rows of data that must be merged.
     On an earlier run with 4000 lines from the PACS only two cases was found.
     Both cases included cancelled procedures.
+    All the (patient, date) groups with more than one accession number and more than one booking time are found
+    in one groupby over the data, and returned as a dataframe with one row per accession number and booking time
+    in each group. If verbose is True, the groups are also printed.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -503,28 +837,102 @@ def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df
         print('\n')
         return 
 
-    # Make a list of all patients with multiple bookings on the same day with different accession numbers:
-    patient_list = df_ids7['Pasient'].drop_duplicates()
-    for patient in patient_list:
-        # Get the booking times for this patient:
-        booking_times = df_ids7[df_ids7['Pasient'] == patient]['Bestilt dato og tidspunkt']
-        # Sort the booking times:
-        booking_times = booking_times.sort_values()
-        # if there is more than one booking:
-        if len(booking_times) > 1:
-            # loop through all bookings:
-            for i in range(len(booking_times)-1):
-                # Check if the booking times are on the same day but different time with different accesstion numbers:
-                if (booking_times.iloc[i].date() == booking_times.iloc[i+1].date()) & (booking_times.iloc[i].time() != booking_times.iloc[i+1].time()):
-                    # Get the accession numbers:
-                    acc_no = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == booking_times.iloc[i])]['Henvisnings-ID'].drop_duplicates()
-                    # Check if there are multiple accession numbers:
-                    if len(acc_no) > 1:
-                        print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(booking_times.iloc[i].date()) + ':')
-                        print(acc_no)
-                        print('')
-
-def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual_replace=False):
+    # Find all the (patient, date) groups with more than one accession number at different times:
+    bookings = _get_bookings(df_ids7)
+    bookings.insert(1, 'Bestilt dato', bookings['Bestilt dato og tidspunkt'].dt.normalize())
+    groups = bookings.groupby(['Pasient', 'Bestilt dato'])
+    is_duplicate = (groups['Henvisnings-ID'].transform('nunique') > 1) & \
+                   (groups['Bestilt dato og tidspunkt'].transform('nunique') > 1)
+    duplicates = bookings[is_duplicate].sort_values(by=['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID'])
+    duplicates = duplicates.reset_index(drop=True)
+
+    if verbose:
+        for (patient, date), group in duplicates.groupby(['Pasient', 'Bestilt dato'], sort=False):
+            print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(date.date()) + ':')
+            print(group[['Bestilt dato og tidspunkt', 'Henvisnings-ID']].to_string(index=False))
+            print('')
+
+    return duplicates
+
+def _classify_duplicated_accession_groups(df_ids7):
+    """
+    This function finds all the (Pasient, Bestilt dato og tidspunkt) groups with more than one accession number,
+    where some of the accession numbers are in DoseTrack and some are not.
+    Whether an accession number is in DoseTrack is read from the first row of the accession number in the group.
+    Groups with exactly one accession number in DoseTrack can be corrected automatically, the rest must be reviewed.
+    Returns two dataframes with one row per accession number in each group:
+    the groups that can be corrected automatically, and the groups that must be reviewed.
+    """
+    keys = ['Pasient', 'Bestilt dato og tidspunkt']
+    accessions = df_ids7.dropna(subset=keys + ['Henvisnings-ID']) \
+                        .groupby(keys + ['Henvisnings-ID'])['Henvisning_i_dt'].first().reset_index()
+    accessions['Henvisning_i_dt'] = accessions['Henvisning_i_dt'].astype(bool)
+
+    groups = accessions.groupby(keys)['Henvisning_i_dt']
+    n_accessions = groups.transform('size')
+    n_in_dt = groups.transform('sum')
+    is_conflict = (n_accessions > 1) & (n_in_dt > 0) & (n_in_dt < n_accessions)
+
+    auto = accessions[is_conflict & (n_in_dt == 1)].reset_index(drop=True)
+    review = accessions[is_conflict & (n_in_dt > 1)].reset_index(drop=True)
+    return auto, review
+
+def _rows_in_groups(df_ids7, groups):
+    """
+    This function returns an array with the value of groups['Valgt Henvisnings-ID'] for each row in df_ids7 that belongs 
+    to one of the (Pasient, Bestilt dato og tidspunkt) groups, and NaN for all other rows.
+    """
+    keys = ['Pasient', 'Bestilt dato og tidspunkt']
+    chosen = groups.drop_duplicates(subset=keys).set_index(keys)['Valgt Henvisnings-ID']
+    return chosen.reindex(pd.MultiIndex.from_frame(df_ids7[keys])).to_numpy()
+
+def _review_table(df_ids7, review):
+    """
+    This function builds the table of ambiguous accession numbers that must be reviewed manually.
+    The descriptions of each accession number are added to help the review, and the column 'Valgt Henvisnings-ID'
+    is left empty for the user to fill in with the accession number that should be used for the group.
+    """
+    review = review.copy()
+    if 'Beskrivelse' in df_ids7.columns:
+        keys = ['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID']
+        # Only the rows of the accession numbers under review are needed, and each description is only listed once:
+        rows = pd.MultiIndex.from_frame(df_ids7[keys]).isin(pd.MultiIndex.from_frame(review[keys]))
+        descriptions = df_ids7.loc[rows, keys + ['Beskrivelse']].dropna().astype({'Beskrivelse': str}) \
+                              .drop_duplicates().groupby(keys)['Beskrivelse'].agg(', '.join)
+        review['Beskrivelse'] = descriptions.reindex(pd.MultiIndex.from_frame(review[keys])).to_numpy()
+    review['Valgt Henvisnings-ID'] = pd.Series(index=review.index, dtype='str')
+    return review
+
+def _print_review_group(group):
+    """
+    This function prints the accession numbers with and without data in dosetrack, along with descriptions,
+    for one (Pasient, Bestilt dato og tidspunkt) group in the review table.
+    """
+    print('Accession numbers without data in dosetrack:')
+    for _, row in group[group['Henvisning_i_dt'] == False].iterrows():
+        print(row['Henvisnings-ID'] + ', Beskrivelse: ')
+        if 'Beskrivelse' in group.columns:
+            print(row['Beskrivelse'])
+    print('\n')
+    print('Accession numbers with data in dosetrack:')
+    for _, row in group[group['Henvisning_i_dt'] == True].iterrows():
+        print(row['Henvisnings-ID'] + ', Beskrivelse: ')
+        if 'Beskrivelse' in group.columns:
+            print(row['Beskrivelse'])
+
+def _apply_chosen_accession_numbers(df_ids7, groups):
+    """
+    This function inserts the accession number in groups['Valgt Henvisnings-ID'] into all the rows for the same patient
+    and booking time with no dosetrack data, with a single assignment.
+    Returns the dataframe and whether any accession numbers were changed.
+    """
+    chosen = _rows_in_groups(df_ids7, groups)
+    rows_to_change = pd.notna(chosen) & (df_ids7['Henvisning_i_dt'] == False).to_numpy()
+    if rows_to_change.any():
+        df_ids7.loc[rows_to_change, 'Henvisnings-ID'] = chosen[rows_to_change]
+    return df_ids7, bool(rows_to_change.any())
+
+def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual_replace=False, review_file=None):
     """
     For a few patients having a procedure, there has been created two accession numbers in IDS7.
     DoseTrack will only use one of these if the patient only got one procedure.
@@ -532,6 +940,12 @@ def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual
     If only one of these are in dosetrack while the rest is not, the accession number will be overwritten by the accession number
     used by dosetrack. If both or non of the accesssion numbers are in used, they remain untouched.
     After the accession numbers have been overwritten the function check_accession_ids7_vs_dt is run from this function.
+
+    All the groups are classified in one pass, and the automatic corrections are applied with a single assignment.
+    Groups with two or more accession numbers in dosetrack and at least one without are ambiguous, and are queued for review:
+    If review_file is given, the review table is written to this csv file. Fill in the column 'Valgt Henvisnings-ID'
+    and apply it with apply_accession_number_review.
+    If manual_replace is True, the user is asked to enter the accession number for each queued group after the automatic corrections.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -563,75 +977,110 @@ def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual
             print('The column Henvisning_i_dt does not exist. Running check_accession_ids7_vs_dt')
         df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
 
-    # Go through all the patients in the IDS7 data:
-    patient_list = df_ids7['Pasient'].unique()
-    status_changed = False
-    for patient in patient_list:
-        # Go through all the individual booking times for this patient:
-        booking_times = sorted(df_ids7[df_ids7['Pasient'] == patient]['Bestilt dato og tidspunkt'].unique())
-        for time in booking_times:
-            # Get the accession number for this patient at this booking time:
-            acc_nr = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time)]['Henvisnings-ID'].unique()
-            # Check if there is more than one accession number for this patient at this time:
-            if len(acc_nr) > 1:
-                # Make a pandas series with accession numbers as index and true/false as values:
-                acc_nr_in_dt = pd.Series(index=acc_nr, data = np.nan)
-                # Go through all the accession numbers for this patient at this time:
-                for acc in acc_nr:
-                    # Check if the accession number is in the DoseTrack data:
-                    acc_nr_in_dt[acc] = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisnings-ID'] == acc)]['Henvisning_i_dt'].values[0]
-                # Check if there are both true and false values:
-                if acc_nr_in_dt.nunique() > 1:
-                    # Warn the user that there might be ambigous data regarding this procedure if there are several true and at least one false:
-                    if len(acc_nr_in_dt[acc_nr_in_dt == True]) > 1 and len(acc_nr_in_dt[acc_nr_in_dt == False]) > 0:
-                        print('WARNING: there are two or more accessions with data in dosetrack and at least one without.')
-                        print('Please investigate patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(acc_nr))
-                        # Loop to help the user manually enter the accession number that should be used:
-                        if manual_replace:
-                            while True:
-                                # Get the user to enter the accession number that should be used:
-                                print('\n')
-                                print('Please enter the accession number that should be used:')
-                                # List the accession numbers without data in dosetrack along with descriptions:
-                                print('Accession numbers without data in dosetrack:')
-                                for acc in acc_nr_in_dt[acc_nr_in_dt == False].index:
-                                    print(acc + ', Beskrivelse: ')
-                                    for beskrivelse in df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisnings-ID'] == acc)]['Beskrivelse']:
-                                        print(beskrivelse)
-                                # List the accession numbers with data in dosetrack along with descriptions:
-                                print('\n')
-                                print('Accession numbers with data in dosetrack:')
-                                for acc in acc_nr_in_dt[acc_nr_in_dt == True].index:
-                                    print(acc + ', Beskrivelse: ')
-                                    for beskrivelse in df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisnings-ID'] == acc)]['Beskrivelse']:
-                                        print(beskrivelse)                                   
-                                manual_input = input()
-                                # Check if the accession number is in the list of accession numbers for this patient at this time with data in dosetrack:
-                                if manual_input in acc_nr_in_dt[acc_nr_in_dt == True].index:
-                                    # Insert the manually entered accession number into all the rows for the same patient and booking with no dosetrack data:
-                                    df_ids7.loc[(df_ids7['Pasient'] == patient) & \
-                                                (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisning_i_dt'] == False) \
-                                                , 'Henvisnings-ID'] = manual_input
-                                    status_changed = True
-                                    print('Inserted accession number: ' + str(manual_input) + ' for patient: ' + str(patient) + ', time: ' + str(time) + ' for elements not in dosetrack.')
-                                    break
-                                print('WARNING!!! The accession number you entered is not in the list of accession numbers with data in dosetrack.')
-                        else:
-                            print('Switch the manual_replace flag to True to enable manual accession number replacement.')
-                    else:
-                        # Insert the accession number which is included in the DoseTrack data into all the rows for the same 
-                        # patient and booking with no dosetrack data:
-                        df_ids7.loc[(df_ids7['Pasient'] == patient) & \
-                                    (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                    (df_ids7['Henvisning_i_dt'] == False) \
-                                    , 'Henvisnings-ID'] = acc_nr_in_dt[acc_nr_in_dt == True].index[0]
-                        status_changed = True
-                        print('Inserted accession number: ' + str(acc_nr_in_dt[acc_nr_in_dt == True].index[0]) + \
-                            ' for patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(acc_nr))
+    # Classify all the patient and booking time groups with more than one accession number:
+    auto, review = _classify_duplicated_accession_groups(df_ids7)
+
+    # Insert the accession number which is included in the DoseTrack data into all the rows for the same 
+    # patient and booking with no dosetrack data:
+    auto['Valgt Henvisnings-ID'] = auto['Henvisnings-ID'].where(auto['Henvisning_i_dt'])
+    auto['Valgt Henvisnings-ID'] = auto.groupby(['Pasient', 'Bestilt dato og tidspunkt'])['Valgt Henvisnings-ID'].transform('first')
+    df_ids7, status_changed = _apply_chosen_accession_numbers(df_ids7, auto)
+    for (patient, time), group in auto.groupby(['Pasient', 'Bestilt dato og tidspunkt']):
+        print('Inserted accession number: ' + str(group['Valgt Henvisnings-ID'].iloc[0]) + \
+              ' for patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(group['Henvisnings-ID'].tolist()))
+
+    # Warn the user that there might be ambigous data regarding the procedures with several true and at least one false:
+    review = _review_table(df_ids7, review)
+    for (patient, time), group in review.groupby(['Pasient', 'Bestilt dato og tidspunkt']):
+        print('WARNING: there are two or more accessions with data in dosetrack and at least one without.')
+        print('Please investigate patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(group['Henvisnings-ID'].tolist()))
+
+    if len(review) > 0:
+        if review_file is not None:
+            review.to_csv(review_file, index=False)
+            print('The ambiguous accession numbers have been written to: ' + str(review_file))
+            print('Fill in the column "Valgt Henvisnings-ID" and apply it with apply_accession_number_review.')
+        if manual_replace:
+            # Loop to help the user manually enter the accession number that should be used, one group at a time:
+            for (patient, time), group in review.groupby(['Pasient', 'Bestilt dato og tidspunkt']):
+                while True:
+                    # Get the user to enter the accession number that should be used:
+                    print('\n')
+                    print('Patient: ' + str(patient) + ', time: ' + str(time))
+                    print('Please enter the accession number that should be used:')
+                    _print_review_group(group)
+                    manual_input = input()
+                    # Check if the accession number is in the list of accession numbers for this patient at this time with data in dosetrack:
+                    if manual_input in group[group['Henvisning_i_dt'] == True]['Henvisnings-ID'].values:
+                        review.loc[group.index, 'Valgt Henvisnings-ID'] = manual_input
+                        print('Inserted accession number: ' + str(manual_input) + ' for patient: ' + str(patient) + ', time: ' + str(time) + ' for elements not in dosetrack.')
+                        break
+                    print('WARNING!!! The accession number you entered is not in the list of accession numbers with data in dosetrack.')
+            df_ids7, manual_changed = _apply_chosen_accession_numbers(df_ids7, review.dropna(subset=['Valgt Henvisnings-ID']))
+            status_changed = status_changed or manual_changed
+        elif review_file is None:
+            print('Switch the manual_replace flag to True to enable manual accession number replacement,')
+            print('or pass a review_file to review the accession numbers later.')
+
+    if status_changed:
+        # Run the function check_accession_ids7_vs_dt again to update the column Henvisning_i_dt:
+        if verbose:
+            print('The accession numbers have been changed. Running check_accession_ids7_vs_dt')
+        df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
+
+    return df_ids7
+
+def get_accession_number_review_table(df_ids7, df_dt, verbose=False):
+    """
+    This function returns the table of ambiguous accession numbers that overwrite_duplicated_accession_numbers
+    cannot correct automatically: patients with two or more accession numbers with data in dosetrack and at least
+    one without at the same booking time. There is one row per accession number. 
+    Fill in the column 'Valgt Henvisnings-ID' for each group and apply it with apply_accession_number_review.
+    """
+    # Test if the column Henvisning_i_dt exists:
+    if 'Henvisning_i_dt' not in df_ids7.columns:
+        df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
+    _, review = _classify_duplicated_accession_groups(df_ids7)
+    return _review_table(df_ids7, review)
+
+def apply_accession_number_review(df_ids7, df_dt, review, verbose=False):
+    """
+    This function applies a filled in review table from overwrite_duplicated_accession_numbers or 
+    get_accession_number_review_table. The review can be a dataframe or the path to the csv file.
+    For each patient and booking time with a 'Valgt Henvisnings-ID', the accession number is inserted into all the rows
+    with no dosetrack data. The chosen accession number must be one of the accession numbers with data in dosetrack.
+    After the accession numbers have been overwritten the function check_accession_ids7_vs_dt is run from this function.
+    """
+    # Stop execution if the dataframe contains the column 'Fødselsnummer':
+    if _check_for_fnr(df_ids7):
+        return df_ids7
+
+    if not isinstance(review, pd.DataFrame):
+        review = pd.read_csv(review, dtype={'Henvisnings-ID': str, 'Valgt Henvisnings-ID': str},
+                             parse_dates=['Bestilt dato og tidspunkt'])
+        review['Pasient'] = review['Pasient'].astype(df_ids7['Pasient'].dtype)
+
+    # Use the first filled in accession number of each group:
+    keys = ['Pasient', 'Bestilt dato og tidspunkt']
+    review = review.copy()
+    review['Valgt Henvisnings-ID'] = review.groupby(keys)['Valgt Henvisnings-ID'].transform('first')
+    review = review.dropna(subset=['Valgt Henvisnings-ID'])
+    if len(review) == 0:
+        print('No reviewed accession numbers to apply')
+        return df_ids7
+
+    # Check that the chosen accession number is one of the accession numbers with data in dosetrack:
+    is_chosen = (review['Henvisning_i_dt'] == True) & (review['Henvisnings-ID'] == review['Valgt Henvisnings-ID'])
+    is_valid = is_chosen.groupby([review[key] for key in keys]).any()
+    for patient, time in is_valid[~is_valid].index:
+        print('WARNING!!! The accession number entered for patient: ' + str(patient) + ', time: ' + str(time) + \
+              ' is not in the list of accession numbers with data in dosetrack. This group is skipped.')
+    valid_groups = pd.MultiIndex.from_frame(review[keys]).isin(is_valid[is_valid].index)
+    df_ids7, status_changed = _apply_chosen_accession_numbers(df_ids7, review[valid_groups])
+
+    if verbose:
+        print('Applied the reviewed accession numbers for {} patient and booking time groups.'.format(int(is_valid.sum())))
+
     if status_changed:
         # Run the function check_accession_ids7_vs_dt again to update the column Henvisning_i_dt:
         if verbose:
@@ -641,12 +1090,13 @@ def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual
     return df_ids7
 
 # Funciton for merging IDS7 and DoseTrack dataframes:
-def merge_ids7_dt(df_ids7, df_dt, verbose=False):
+def merge_ids7_dt(df_ids7, df_dt, verbose=False, compact=False):
     """ 
     This function merged the data from IDS7 and DoseTrack based on accession number.
     In the process of preparing the merge of the IDS7 data, all the procedure descriptions for the same 
     accession number are concatenated into one string.
     For the DoseTrack data, the sum of the DAP, CAK and F+A Time are calculated for each accession number.
+    If compact is True, the merged dataframe is passed through compact_dataframe to reduce its memory usage.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -697,7 +1147,18 @@ def merge_ids7_dt(df_ids7, df_dt, verbose=False):
     agg_dict_dt = _add_optional_columns(df_dt, agg_dict_dt, agg_dict_dt_optional, 'DoseTrack', verbose=verbose)
 
     
-    df_ids7_to_merge = df_ids7[df_ids7['Henvisning_i_dt'] == True].groupby('Henvisnings-ID', as_index = False).agg(agg_dict_ids7)
+    ids7_rows = df_ids7[df_ids7['Henvisning_i_dt'] == True]
+    # The descriptions are concatenated for all accession numbers at once, unless the column has missing values or is
+    # not a text column, where _concatenate_protocol is used for each accession number:
+    concatenate_at_once = (pd.api.types.is_string_dtype(ids7_rows['Beskrivelse'])
+                           and not isinstance(ids7_rows['Beskrivelse'].dtype, pd.CategoricalDtype)
+                           and ids7_rows['Beskrivelse'].notna().all())
+    if concatenate_at_once:
+        agg_dict_ids7['Beskrivelse'] = 'first'
+    df_ids7_to_merge = ids7_rows.groupby('Henvisnings-ID', as_index = False).agg(agg_dict_ids7)
+    if concatenate_at_once and len(df_ids7_to_merge) > 0:
+        df_ids7_to_merge['Beskrivelse'] = pd.Series(_concatenate_protocols(ids7_rows, 'Henvisnings-ID'),
+                                                    index=df_ids7_to_merge.index)
 
     # Prepare the DoseTrack data for merge:
     df_dt_to_merge = df_dt[df_dt['Henvisning_i_ids7'] == True].groupby('Accession Number', as_index = False).agg(agg_dict_dt)
@@ -711,37 +1172,108 @@ def merge_ids7_dt(df_ids7, df_dt, verbose=False):
     if verbose:
         print('The IDS7 and DoseTrack has merged data of length: {}'.format(len(data)))
 
+    if compact:
+        data = compact_dataframe(data, verbose=verbose)
+
     return data
 
+# Function for reducing the memory usage of the dataframes:
+def compact_dataframe(df, max_category_ratio=0.5, downcast_floats=False, verbose=False):
+    """
+    This function reduces the memory usage of a dataframe, e.g. the merged data or the exposure level DoseTrack data:
+    Text columns where the number of unique values is at most max_category_ratio times the number of rows 
+    (such as 'Modality Room', 'Beskrivelse', 'Mapped Procedures', 'Kjønn', 'Acquisition Protocol Name' and the 
+    accession numbers in the exposure level data) are converted to categoricals.
+    Integer columns are downcast to the smallest integer type that holds the values.
+    Float columns such as the dose and time columns are kept as float64 by default. If downcast_floats is True,
+    they are downcast to float32, which saves more memory but only keeps about 7 significant digits.
+    The memory usage before and after is printed. If verbose is True, the change is also printed per column.
+    """
+    memory_before = df.memory_usage(deep=True).sum()
+    df = df.copy()
+
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(series):
+            continue
+
+        if pd.api.types.is_string_dtype(series) and pd.api.types.infer_dtype(series, skipna=True) in ['string', 'empty']:
+            if series.nunique() <= max_category_ratio * len(series):
+                df[column] = series.astype('category')
+        elif pd.api.types.is_integer_dtype(series):
+            df[column] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series) and downcast_floats:
+            df[column] = pd.to_numeric(series, downcast='float')
+
+        if verbose and df[column].dtype != series.dtype:
+            print('{}: {} -> {} ({:.1f} MB -> {:.1f} MB)'.format(column, series.dtype, df[column].dtype,
+                                                                 series.memory_usage(deep=True) / 1e6,
+                                                                 df[column].memory_usage(deep=True) / 1e6))
+
+    memory_after = df.memory_usage(deep=True).sum()
+    print('Memory usage reduced from {:.1f} MB to {:.1f} MB ({:.0f}% saved).'.format(
+          memory_before / 1e6, memory_after / 1e6, 100 * (1 - memory_after / memory_before) if memory_before else 0))
+    return df
+
 # Utility function to run all filters and checks:
-def run_all_cleanup_filters_and_checks(df_ids7, df_dt, verbose=False, manual_replace=False):
+def run_all_cleanup_filters_and_checks(df_ids7, df_dt, verbose=False, manual_replace=False, review_file=None,
+                                       return_summary=False):
     """
     This utilityfunction runs the following funcions:
-    filter_NaT
     remove_unnecessary_columns
+    filter_NaT
     filter_cancelled
     filter_phantom_etc
     check_accession_format
     check_accession_ids7_vs_dt
     overwrite_duplicated_accession_numbers
+    The filters are collected in a CleanupPipeline and applied to the IDS7 dataframe in one step.
+    If verbose is True, the number of rows removed by each filter is printed as a table.
+    If return_summary is True, this table is also returned: df_ids7, summary = run_all_cleanup_filters_and_checks(...)
     """
-    df_ids7 = remove_unnecessary_columns(df_ids7, verbose=verbose)
-    df_ids7 = filter_NaT(df_ids7, verbose=verbose)
-    df_ids7 = filter_cancelled(df_ids7, verbose=verbose)
-    df_ids7 = filter_phantom_etc(df_ids7, verbose=verbose)
-    df_ids7 = check_accession_format(df_ids7, verbose=verbose)
+    # Stop execution if the dataframe contains the column 'Fødselsnummer':
+    if _check_for_fnr(df_ids7):
+        return (df_ids7, None) if return_summary else df_ids7
+
+    pipeline = build_cleanup_pipeline(df_ids7, verbose=verbose)
+    df_ids7 = pipeline.run()
+    summary = pipeline.summary()
+    if verbose:
+        print(summary.to_string(index=False))
+        print('\n')
+
     df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
-    df_ids7 = overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=verbose, manual_replace=manual_replace)
+    df_ids7 = overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=verbose, manual_replace=manual_replace, review_file=review_file)
     df_dt   = check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=verbose)
 
+    if return_summary:
+        return df_ids7, summary
     return df_ids7
 
 # Functions for exporting the data:
-def export_examination_codes_to_text_file(df_data, laboratory=None):
+def _count_examination_codes(df_data, lab_col, accession_col):
+    """
+    This utility function joins the sorted, unique descriptions of each accession number per lab into one
+    examination code, and counts the accession numbers with each examination code per lab.
+    Returns a dataframe with the columns lab_col, 'Examination codes' and 'n', sorted by lab and examination code.
+    """
+    descriptions = df_data[[lab_col, accession_col, 'Beskrivelse']].dropna()
+    # The descriptions are compared and sorted as text, also when the column is categorical:
+    descriptions = descriptions.astype({lab_col: 'str', 'Beskrivelse': 'str'}).drop_duplicates()
+    descriptions = descriptions.sort_values('Beskrivelse', kind='stable')
+    codes = descriptions.groupby([lab_col, accession_col], sort=False)['Beskrivelse'].agg(', '.join)
+    codes = codes.rename('Examination codes').reset_index()
+    return codes.groupby([lab_col, 'Examination codes']).size().rename('n').reset_index()
+
+def export_examination_codes_to_text_file(df_data, laboratory=None, combined_file=None):
     """
     This function exports the examination codes for all laboratories (if no laboratory argument is given),
     or for a specific laboratory (if the laboratory argument is given).
     The input is the dataframe with the IDS7 data and the name of the lab as a string.
+    The examination codes of all the labs are made in one pass, and one text file per lab is written from them.
+    If combined_file is given, the examination codes of all the labs are also written to that file as one table,
+    for the curation of the mapping dictionaries (Parquet if the file ends with .parquet, otherwise CSV).
+    Returns the table with the lab, the examination code and the number of procedures with that code.
     """
 
     # The following two statements enables the function to work with both the IDS7 and the merged data.
@@ -774,8 +1306,6 @@ def export_examination_codes_to_text_file(df_data, laboratory=None):
         print('\n')
         return
     
-    # Iterate through all the labs in the dataset:
-    
     # Filter the dataset to only include the the given lab is lab is not None:
     if laboratory is not None:
         df_data = df_data[df_data[lab_col] == laboratory]
@@ -783,38 +1313,29 @@ def export_examination_codes_to_text_file(df_data, laboratory=None):
             print('No rows with the given lab: ' + laboratory)
             return
 
-    for lab in df_data[lab_col].unique():
-        df_lab = df_data[df_data[lab_col] == lab]
-        # Exit function with an error if there are no rows with the given lab:
-        if len(df_lab) == 0:
-            print('No rows with the given lab: ' + lab)
-            return
+    code_counts = _count_examination_codes(df_data, lab_col, accession_col)
 
-        # Make an pandas series with an index of the accession numbers that store the codes:
-        codes = pd.Series(index = df_lab[accession_col].unique())
-        for accession_no in codes.index:
-            procedure = df_lab[df_lab[accession_col] == accession_no]['Beskrivelse'].unique()
-            procedure.sort()
-            # Merge all the codes into one string:
-            code = ''
-            for i in procedure:
-                code += i + ', '
-            # Remove the last comma and space:
-            code = code[:-2]
-            # Store the code in the series:
-            codes[accession_no] = code
-
-        # Make a list of unique codes:
-        unique_codes = codes.unique()
-        # Sort the list:
-        unique_codes.sort()
-        # Export the list to a text file in the Reports folder:
-        if not os.path.exists('Reports'):
-                os.makedirs('Reports')
+    # Export the list of each lab to a text file in the Reports folder:
+    if not os.path.exists('Reports'):
+            os.makedirs('Reports')
+    for lab, df_lab in code_counts.groupby(lab_col, sort=False):
         with open('Reports/Examination_codes_' + lab + '.txt', 'w') as f:
             # Write (n=number of procedures) before each code:
-            for code in unique_codes:
-                f.write('(n = ' + str(sum(codes == code)) + ') ' + code + '\n')
+            f.writelines('(n = ' + str(n) + ') ' + code + '\n'
+                         for code, n in zip(df_lab['Examination codes'], df_lab['n']))
+
+    if combined_file is not None:
+        folder = Path(combined_file).parent
+        os.makedirs(folder, exist_ok=True)
+        if str(combined_file).endswith('.parquet'):
+            if importlib.util.find_spec('pyarrow') is None:
+                print('WARNING: pyarrow is not installed, so the examination codes cannot be saved as Parquet.')
+                print('\n')
+            else:
+                code_counts.to_parquet(combined_file, index=False)
+        else:
+            code_counts.to_csv(combined_file, index=False)
+    return code_counts
 
 def delete_reports(delete_folder=False):
     """
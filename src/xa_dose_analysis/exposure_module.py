@@ -0,0 +1,390 @@
+"""
+This module contains functions for working with the exposure level DoseTrack data (one row per exposure),
+which is much larger than the series level data, and therefore benefits from being aggregated once and reused.
+
+-------------------------------- Accession number index: --------------------------------
+AccessionIndex:                 The exposure level data sorted by accession number, with the start and stop row of each
+                                accession number. Selecting all the exposures of a list of accession numbers is a gather
+                                of contiguous slices, instead of a scan of all the exposures with isin.
+
+-------------------------------- Angle binning: --------------------------------
+angle_heatmap_grid:             Sums the Air Kerma of the exposures per C-arm angle bin with np.histogram2d, and returns
+                                the full 2D grid of Air Kerma per angle bin. This is used by plot_air_kerma_angle_heatmap,
+                                but does not depend on matplotlib.
+
+-------------------------------- Angle histogram cube: --------------------------------
+build_angle_histogram_cube:     Sums the Air Kerma of the exposures per accession number and C-arm angle bin
+                                (primary and secondary angle), and returns the result as a sparse table with one row per
+                                accession number and angle bin with Air Kerma. This is done once for all the exposures.
+
+save_angle_histogram_cube:      Saves the angle histogram cube as a Parquet file (requires pyarrow).
+
+load_angle_histogram_cube:      Loads an angle histogram cube saved with save_angle_histogram_cube.
+
+angle_heatmap_from_cube:        Sums the angle histogram cube over a list of accession numbers (e.g. all the accession
+                                numbers of a procedure), and returns the full 2D grid of Air Kerma per angle bin.
+                                The grid can be plotted with plot_module.plot_air_kerma_angle_heatmap_from_cube.
+
+-------------------------------- Procedure level aggregation: --------------------------------
+aggregate_exposures:            Aggregates exposure level DoseTrack data to the procedure level rows (one row per series,
+                                the rows with Ordinal == 1), with the columns merge_ids7_dt needs, and the number of
+                                exposures, DAP and Air Kerma per irradiation event type (e.g. Fluoroscopy).
+
+aggregate_exposure_files:       Does the same as aggregate_exposures for all the Excel files in a folder tree, one file
+                                at a time, so that the exposure level export never has to be held in memory, and the
+                                export does not have to be filtered to Ordinal == 1 in Excel first.
+                                Pass angle_bin_size to also build the angle histogram cube in the same pass.
+-------------------------------------------------------------------------------------
+"""
+
+import os
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from xa_dose_analysis import dt_ids7_export_module as bh_utils
+
+_COL_PRIMARY = 'Positioner Primary Angle (deg)'
+_COL_SECONDARY = 'Positioner Secondary Angle (deg)'
+_COL_AK = 'Air Kerma (mGy)'
+_COL_ACCESSION = 'Accession Number'
+_COL_ORDINAL = 'Ordinal'
+_COL_EVENT_TYPE = 'Irradiation Event Type'
+_COL_DAP = 'Dose Area Product (Gy*cm2)'
+
+# The procedure level columns that are repeated on each exposure, and used by merge_ids7_dt:
+_PROCEDURE_COLUMNS = ['Study Date', 'Age (Years)', 'DAP Total (Gy*cm2)', 'CAK (mGy)', 'F+A Time (s)', 'Modality Room']
+# The sub-totals per irradiation event type, and the name of their columns:
+_EVENT_TYPE_TOTALS = {'Exposures': 'Exposures {}', _COL_DAP: 'DAP {} (Gy*cm2)', _COL_AK: 'Air Kerma {} (mGy)'}
+
+class AccessionIndex:
+    """
+    This class sorts the exposure level data by accession number once, and keeps the start and stop row of each
+    accession number, so that the exposures of any set of accession numbers can be selected without scanning all the rows.
+    The order of the exposures within each accession number is kept. Rows without accession number are not indexed.
+
+    Example:
+    index = AccessionIndex(df_dt_exp)
+    accession_numbers = data[data['Mapped Procedures'] == 'TAVI']['Accession Number'].unique()
+    exp_data = index.select(accession_numbers)
+    """
+    def __init__(self, exp_data, column=_COL_ACCESSION):
+        self.column = column
+        self.data = exp_data.sort_values(by=column, kind='stable', na_position='last')
+
+        # The rows where a new accession number starts:
+        values = self.data[column].to_numpy()
+        n_indexed = len(values) - int(self.data[column].isna().sum())
+        values = values[:n_indexed]
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]]) if n_indexed else np.array([], dtype=int)
+        stops = np.r_[starts[1:], n_indexed].astype(int)
+
+        self.offsets = dict(zip(values[starts], zip(starts.tolist(), stops.tolist())))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, accession_number):
+        return accession_number in self.offsets
+
+    def accession_numbers(self):
+        """
+        Returns the indexed accession numbers, in sorted order.
+        """
+        return list(self.offsets)
+
+    def get(self, accession_number):
+        """
+        Returns the exposures of one accession number (an empty dataframe if the accession number is not indexed).
+        """
+        start, stop = self.offsets.get(accession_number, (0, 0))
+        return self.data.iloc[start:stop]
+
+    def select(self, accession_numbers):
+        """
+        Returns the exposures of the accession numbers, the same rows as exp_data[exp_data[column].isin(accession_numbers)],
+        but grouped by accession number in the order of the accession numbers given.
+        Accession numbers that are not indexed, and repeated accession numbers, are ignored.
+        """
+        slices = [self.offsets[accession_number] for accession_number in dict.fromkeys(accession_numbers)
+                  if accession_number in self.offsets]
+        if not slices:
+            return self.data.iloc[0:0]
+        starts, stops = np.array(slices).T
+        lengths = stops - starts
+        # The row positions of all the slices: each slice start repeated, plus the position within the slice:
+        positions = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+        return self.data.iloc[positions]
+
+def _angle_bin_edges(bin_size):
+    """
+    This utility function returns the bin edges of the primary (-180 to 180 deg) and secondary (-90 to 90 deg) angles.
+    The bins are centered on multiples of bin_size.
+    """
+    half = bin_size / 2
+    primary_bins = np.arange(0 - half, 180 + half + bin_size, bin_size)
+    primary_bins = np.unique(np.concatenate([-primary_bins[::-1], primary_bins]))
+    secondary_bins = np.arange(0 - half, 90 + half + bin_size, bin_size)
+    secondary_bins = np.unique(np.concatenate([-secondary_bins[::-1], secondary_bins]))
+    return primary_bins, secondary_bins
+
+def _angle_bin_centers(bins):
+    """
+    This utility function returns the bin centers (as integers) of a set of bin edges.
+    """
+    return (bins[:-1] + np.diff(bins) / 2).round().astype(int)
+
+def _angle_bin_index(values, bins):
+    """
+    This utility function returns the bin index of each value. The bins include the left edge and exclude the right edge,
+    as pd.cut(right=False). Values outside the bins get the index -1.
+    """
+    index = np.searchsorted(bins, values, side='right') - 1
+    index[(index < 0) | (index >= len(bins) - 1)] = -1
+    return index
+
+def angle_heatmap_grid(primary_angle, secondary_angle, air_kerma, bin_size=10):
+    """
+    This function sums the Air Kerma per primary and secondary angle bin, and returns the full grid as a dataframe with
+    the secondary angle bin centers as index (ascending) and the primary angle bin centers as columns (ascending).
+    The inputs are arrays (or series) of the same length, one value per exposure. Exposures with missing values are dropped.
+    The bins include the left edge and exclude the right edge, the same as pd.cut(right=False).
+
+    Example:
+    grid = angle_heatmap_grid(df['Positioner Primary Angle (deg)'], df['Positioner Secondary Angle (deg)'],
+                              df['Air Kerma (mGy)'], bin_size=10)
+    """
+    primary_angle = np.asarray(primary_angle, dtype=float)
+    secondary_angle = np.asarray(secondary_angle, dtype=float)
+    air_kerma = np.asarray(air_kerma, dtype=float)
+    primary_bins, secondary_bins = _angle_bin_edges(bin_size)
+
+    # np.histogram2d includes the right edge of the last bin, so values on the top edges are dropped to match pd.cut:
+    keep = ~(np.isnan(primary_angle) | np.isnan(secondary_angle) | np.isnan(air_kerma))
+    keep &= (primary_angle != primary_bins[-1]) & (secondary_angle != secondary_bins[-1])
+
+    grid, _, _ = np.histogram2d(secondary_angle[keep], primary_angle[keep], bins=[secondary_bins, primary_bins],
+                                weights=air_kerma[keep])
+    return pd.DataFrame(grid, index=_angle_bin_centers(secondary_bins), columns=_angle_bin_centers(primary_bins))
+
+def build_angle_histogram_cube(exp_data, bin_size=10, verbose=False):
+    """
+    This function sums the Air Kerma of the exposures per accession number, secondary angle bin and primary angle bin.
+    Returns a sparse dataframe with the columns 'Accession Number', 'Secondary Angle Bin (deg)', 'Primary Angle Bin (deg)'
+    and 'Air Kerma (mGy)', with one row for each accession number and angle bin that has exposures.
+    The angle bins are given by their center, and the bin size is stored in the attrs of the dataframe.
+    Exposures with missing angles, Air Kerma or accession number are dropped.
+    """
+    columns = [_COL_ACCESSION, _COL_PRIMARY, _COL_SECONDARY, _COL_AK]
+    missing = [column for column in columns if column not in exp_data.columns]
+    if missing:
+        print('WARNING: The following columns do not exist in the exposure data: ' + ', '.join(missing))
+        print('Without these columns, we cannot build the angle histogram cube.')
+        print('\n')
+        return
+
+    df = exp_data[columns].dropna()
+    primary_bins, secondary_bins = _angle_bin_edges(bin_size)
+    primary_index = _angle_bin_index(df[_COL_PRIMARY].to_numpy(dtype=float), primary_bins)
+    secondary_index = _angle_bin_index(df[_COL_SECONDARY].to_numpy(dtype=float), secondary_bins)
+    in_range = (primary_index >= 0) & (secondary_index >= 0)
+
+    cube = pd.DataFrame({
+        _COL_ACCESSION: df[_COL_ACCESSION].to_numpy()[in_range],
+        'Secondary Angle Bin (deg)': _angle_bin_centers(secondary_bins)[secondary_index[in_range]],
+        'Primary Angle Bin (deg)': _angle_bin_centers(primary_bins)[primary_index[in_range]],
+        _COL_AK: df[_COL_AK].to_numpy(dtype=float)[in_range],
+    })
+    cube = cube.groupby([_COL_ACCESSION, 'Secondary Angle Bin (deg)', 'Primary Angle Bin (deg)'],
+                        sort=True, as_index=False)[_COL_AK].sum()
+    cube.attrs['bin_size'] = bin_size
+
+    if verbose:
+        print('Number of exposures binned: {} of {}'.format(in_range.sum(), len(exp_data)))
+        print('Number of accession numbers in the cube: {}'.format(cube[_COL_ACCESSION].nunique()))
+        print('Number of rows in the cube: {}'.format(len(cube)))
+
+    return cube
+
+def save_angle_histogram_cube(cube, file_path):
+    """
+    This function saves the angle histogram cube (with the bin size) as a Parquet file.
+    """
+    if importlib.util.find_spec('pyarrow') is None:
+        print('WARNING: pyarrow is not installed, so the cube cannot be saved as Parquet.')
+        print('\n')
+        return
+    folder = Path(file_path).parent
+    os.makedirs(folder, exist_ok=True)
+    cube.to_parquet(file_path, index=False)
+
+def load_angle_histogram_cube(file_path):
+    """
+    This function loads an angle histogram cube saved with save_angle_histogram_cube.
+    """
+    return pd.read_parquet(file_path)
+
+def angle_heatmap_from_cube(cube, accession_numbers=None, bin_size=None):
+    """
+    This function sums the angle histogram cube over the accession numbers (all if None), and returns the full grid
+    of Air Kerma per angle bin as a dataframe with the secondary angle bin centers as index (ascending) and the primary
+    angle bin centers as columns (ascending). Bins without exposures are 0.
+    The bin size is read from the attrs of the cube, unless it is given.
+    """
+    if bin_size is None:
+        bin_size = cube.attrs.get('bin_size')
+    if bin_size is None:
+        print('WARNING: The bin size of the cube is unknown. Please give the bin size used to build the cube.')
+        return
+
+    if accession_numbers is not None:
+        cube = cube[cube[_COL_ACCESSION].isin(accession_numbers)]
+
+    primary_bins, secondary_bins = _angle_bin_edges(bin_size)
+    grid = cube.groupby(['Secondary Angle Bin (deg)', 'Primary Angle Bin (deg)'])[_COL_AK].sum().unstack(fill_value=0)
+    grid = grid.reindex(index=_angle_bin_centers(secondary_bins), columns=_angle_bin_centers(primary_bins), fill_value=0)
+    return grid.astype(float)
+
+def _aggregate_series(exp_data):
+    """
+    This utility function aggregates exposure level data that starts with an exposure with Ordinal 1 and has complete
+    series, to one row per series: the procedure level columns of the first exposure, and the sub-totals per
+    irradiation event type. DAP Total and CAK are the sums of the exposures if they are not in the export.
+    """
+    series = np.cumsum(exp_data[_COL_ORDINAL].to_numpy() == 1) - 1
+    n_series = series[-1] + 1 if len(series) else 0
+    first_rows = np.flatnonzero(np.r_[True, series[1:] != series[:-1]]) if len(series) else []
+
+    columns = [column for column in [_COL_ACCESSION] + _PROCEDURE_COLUMNS + ['Source_File'] if column in exp_data.columns]
+    procedures = exp_data.iloc[first_rows][columns].reset_index(drop=True)
+    for total, exposure_column in [('DAP Total (Gy*cm2)', _COL_DAP), ('CAK (mGy)', _COL_AK)]:
+        if total not in exp_data.columns and exposure_column in exp_data.columns:
+            weights = exp_data[exposure_column].fillna(0).to_numpy(dtype=float)
+            procedures[total] = np.bincount(series, weights=weights, minlength=n_series)
+
+    if _COL_EVENT_TYPE in exp_data.columns:
+        values = pd.DataFrame({'Series': series, _COL_EVENT_TYPE: exp_data[_COL_EVENT_TYPE].to_numpy(), 'Exposures': 1})
+        for column in [_COL_DAP, _COL_AK]:
+            if column in exp_data.columns:
+                values[column] = exp_data[column].to_numpy(dtype=float)
+        totals = values.groupby(['Series', _COL_EVENT_TYPE]).sum().unstack(_COL_EVENT_TYPE, fill_value=0)
+        totals.columns = [_EVENT_TYPE_TOTALS[total].format(event_type) for total, event_type in totals.columns]
+        totals = totals.reindex(range(n_series), fill_value=0)
+        procedures = pd.concat([procedures, totals.reset_index(drop=True)], axis=1)
+    return procedures
+
+def _order_event_type_totals(procedures):
+    """
+    This utility function fills the sub-totals that are missing (event types not in all the files) with 0,
+    and puts the sub-totals of each event type next to each other after the procedure level columns.
+    """
+    event_types = sorted({column[len('Exposures '):] for column in procedures.columns if column.startswith('Exposures ')})
+    totals = [name.format(event_type) for event_type in event_types for name in _EVENT_TYPE_TOTALS.values()
+              if name.format(event_type) in procedures.columns]
+    procedures[totals] = procedures[totals].fillna(0)
+    for event_type in event_types:
+        procedures['Exposures ' + event_type] = procedures['Exposures ' + event_type].astype(int)
+    columns = [column for column in procedures.columns if column not in totals]
+    return procedures[columns + totals]
+
+def aggregate_exposures(exp_data, verbose=False):
+    """
+    This function aggregates exposure level DoseTrack data to procedure level rows, which can be used as the DoseTrack
+    data in run_all_cleanup_filters_and_checks and merge_ids7_dt.
+    Each series starts with the exposure with Ordinal 1, and gives one row with the Accession Number and the procedure
+    level columns of that exposure (Study Date, Age (Years), DAP Total (Gy*cm2), CAK (mGy), F+A Time (s), Modality Room),
+    which is the same as filtering the export to Ordinal == 1. DAP Total and CAK are the sums of the exposures if they are
+    not in the export. If the export has the column 'Irradiation Event Type', the number of exposures, DAP and Air Kerma
+    per event type are added, e.g. 'Exposures Fluoroscopy', 'DAP Fluoroscopy (Gy*cm2)' and 'Air Kerma Fluoroscopy (mGy)'.
+    The exposures must be in the order of the export. Exposures before the first exposure with Ordinal 1 are dropped.
+    """
+    if not bh_utils._check_for_column(exp_data, 'DoseTrack', _COL_ORDINAL):
+        print('Without this column, we do not know where each series starts.')
+        print('\n')
+        return
+
+    is_first = (exp_data[_COL_ORDINAL] == 1).to_numpy()
+    n_orphans = int(np.argmax(is_first)) if is_first.any() else len(exp_data)
+    if n_orphans > 0:
+        print('WARNING: {} exposures before the first exposure with Ordinal 1 are dropped.'.format(n_orphans))
+
+    procedures = _order_event_type_totals(_aggregate_series(exp_data.iloc[n_orphans:]))
+    if verbose:
+        print('Number of exposures aggregated: {}'.format(len(exp_data) - n_orphans))
+        print('Number of procedure level rows: {}'.format(len(procedures)))
+    return procedures
+
+def aggregate_exposure_files(root_folder, cache_folder=None, angle_bin_size=None, verbose=False):
+    """
+    This function aggregates all the exposure level DoseTrack Excel files in a folder tree to procedure level rows,
+    as aggregate_exposures, but reads and aggregates one file at a time, so that only one file is held in memory.
+    The files are read in sorted order, and a series that continues in the next file is aggregated with that file.
+    If a cache folder is given, the parsed workbooks are cached as in import_excel_files_to_dataframe.
+    If angle_bin_size is given, the angle histogram cube (see build_angle_histogram_cube) is built in the same pass,
+    and the function returns both the procedure level rows and the cube.
+    If no exposures are aggregated, the function returns None, or (None, None) if angle_bin_size is given.
+    """
+    if cache_folder is not None:
+        if importlib.util.find_spec('pyarrow') is None:
+            print('WARNING: pyarrow is not installed, so the Excel files cannot be cached.')
+            print('\n')
+            cache_folder = None
+        else:
+            os.makedirs(cache_folder, exist_ok=True)
+
+    procedures = []
+    cubes = []
+    # The exposures of the last series of the previous file, which may continue in the next file:
+    pending = None
+    for file_path in sorted(Path(root_folder).rglob('*.xlsx')):
+        print(f"Reading {file_path}...")
+        df, error = bh_utils._read_excel_file(file_path, cache_folder=cache_folder)
+        if error is not None:
+            print(f"Error reading {file_path}: {error}")
+            continue
+        if not bh_utils._check_for_column(df, 'DoseTrack', _COL_ORDINAL):
+            print('The file is skipped, as we do not know where each series starts.')
+            continue
+
+        if angle_bin_size is not None:
+            cube = build_angle_histogram_cube(df, bin_size=angle_bin_size)
+            if cube is not None:
+                cubes.append(cube)
+
+        if pending is not None:
+            df = pd.concat([pending, df], ignore_index=True)
+        is_first = (df[_COL_ORDINAL] == 1).to_numpy()
+        if not is_first.any():
+            pending = df
+            continue
+        n_orphans = int(np.argmax(is_first))
+        if n_orphans > 0:
+            print('WARNING: {} exposures before the first exposure with Ordinal 1 are dropped.'.format(n_orphans))
+        last_start = len(is_first) - 1 - int(np.argmax(is_first[::-1]))
+        if last_start > n_orphans:
+            procedures.append(_aggregate_series(df.iloc[n_orphans:last_start]))
+        pending = df.iloc[last_start:]
+
+    if pending is not None and (pending[_COL_ORDINAL] == 1).any():
+        procedures.append(_aggregate_series(pending))
+    if not procedures:
+        print('WARNING: No exposures were aggregated from: ' + str(root_folder))
+        if angle_bin_size is not None:
+            return None, None
+        return
+
+    procedures = _order_event_type_totals(pd.concat(procedures, ignore_index=True))
+    if verbose:
+        print('Number of procedure level rows: {}'.format(len(procedures)))
+
+    if angle_bin_size is None:
+        return procedures
+    if not cubes:
+        return procedures, None
+    # The exposures of an accession number can be in more than one file, so the cubes of the files are summed:
+    cube = pd.concat(cubes, ignore_index=True).groupby([_COL_ACCESSION, 'Secondary Angle Bin (deg)',
+                                                        'Primary Angle Bin (deg)'], sort=True, as_index=False)[_COL_AK].sum()
+    cube.attrs['bin_size'] = angle_bin_size
+    return procedures, cube
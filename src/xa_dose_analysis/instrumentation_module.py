@@ -0,0 +1,184 @@
+"""
+This module contains functions for measuring where the time and memory is spent when running the analysis.
+
+When the instrumentation is enabled, the public functions in dt_ids7_export_module, mapping_module and reporting_module
+(and the internal stages _perform_mapping and _calc_ci) are replaced by wrappers that record, for each call:
+the wall time, the number of rows in (the first dataframe or series argument), the number of rows out (the returned
+dataframe or series) and the peak memory allocated during the call (with tracemalloc).
+Calls between the functions are also recorded, with the depth of the call, so that e.g. the time spent in
+overwrite_duplicated_accession_numbers can be seen inside run_all_cleanup_filters_and_checks.
+When the instrumentation is disabled, the original functions are put back, so it costs nothing.
+
+Note that tracemalloc slows down the code while it is tracing. Pass track_memory=False to only measure the time.
+
+Example:
+from xa_dose_analysis import instrumentation_module as bh_instr
+bh_instr.enable_instrumentation()
+df_ids7 = bh_utils.run_all_cleanup_filters_and_checks(df_ids7, df_dt)
+data = bh_utils.merge_ids7_dt(df_ids7, df_dt)
+data = bh_map.map_procedures(data, mapping_dict)
+bh_instr.disable_instrumentation()
+print(bh_instr.get_instrumentation_results())
+
+-------------------------------- Functions: --------------------------------
+enable_instrumentation:             Replaces the functions with the recording wrappers.
+disable_instrumentation:            Puts the original functions back.
+instrumentation:                    Context manager that enables the instrumentation inside a with block.
+get_instrumentation_results:        Returns the recorded calls as a dataframe.
+save_instrumentation_results:       Writes the recorded calls to a JSON file.
+clear_instrumentation_results:      Removes the recorded calls.
+-------------------------------------------------------------------------------------
+"""
+
+import contextlib
+import functools
+import inspect
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+from xa_dose_analysis import dt_ids7_export_module
+from xa_dose_analysis import mapping_module
+from xa_dose_analysis import reporting_module
+
+_MODULES = [dt_ids7_export_module, mapping_module, reporting_module]
+# Internal functions that are stages of their own:
+_INTERNAL_STAGES = {mapping_module: ['_perform_mapping'], reporting_module: ['_calc_ci']}
+
+# The original functions, keyed by (module, name), while the instrumentation is enabled:
+_originals = {}
+# The recorded calls, and the calls that are currently running:
+_results = []
+_stack = []
+_state = {'track_memory': True, 'started_tracemalloc': False}
+_COLUMNS = ['Stage', 'Depth', 'Wall time (s)', 'Rows in', 'Rows out', 'Peak memory (MB)']
+
+def _count_rows(value):
+    """
+    This utility function returns the number of rows of a dataframe or series, or of the first element of a tuple
+    (e.g. the dataframe in (df_ids7, summary)), and None for anything else.
+    """
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+def _rows_in(args, kwargs):
+    """
+    This utility function returns the number of rows of the first dataframe or series argument.
+    """
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return len(value)
+    return None
+
+def _instrumented(function, stage):
+    """
+    This utility function returns a wrapper around the function that records the call.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        track_memory = _state['track_memory'] and tracemalloc.is_tracing()
+        frame = {'child_peak': 0}
+        if track_memory:
+            frame['start'], peak = tracemalloc.get_traced_memory()
+            # The peak of the calling call so far is kept, as it is lost when the peak is reset:
+            if _stack:
+                _stack[-1]['child_peak'] = max(_stack[-1]['child_peak'], peak)
+            tracemalloc.reset_peak()
+        record = {'Stage': stage, 'Depth': len(_stack), 'Rows in': _rows_in(args, kwargs)}
+        _results.append(record)
+        _stack.append(frame)
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            record['Wall time (s)'] = time.perf_counter() - start
+            _stack.pop()
+            if track_memory:
+                # The peak is reset at the start of each call inside this call, so the traced peak only covers the
+                # time after the last of them started. The peaks before each reset are kept in child_peak:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame['child_peak'])
+                record['Peak memory (MB)'] = (peak - frame['start']) / 1024**2
+                if _stack:
+                    _stack[-1]['child_peak'] = max(_stack[-1]['child_peak'], peak)
+        record['Rows out'] = _count_rows(result)
+        return result
+    return wrapper
+
+def _functions_to_instrument(module):
+    """
+    This utility function returns the names of the public functions defined in the module, and its internal stages.
+    """
+    names = [name for name, function in inspect.getmembers(module, inspect.isfunction)
+             if not name.startswith('_') and function.__module__ == module.__name__]
+    return names + _INTERNAL_STAGES.get(module, [])
+
+def enable_instrumentation(track_memory=True):
+    """
+    This function replaces the public functions in dt_ids7_export_module, mapping_module and reporting_module
+    (and _perform_mapping and _calc_ci) with wrappers that record each call.
+    If track_memory is True, tracemalloc is started (if it is not already running) to record the peak memory.
+    """
+    if _originals:
+        print('WARNING: The instrumentation is already enabled.')
+        return
+    _state['track_memory'] = track_memory
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state['started_tracemalloc'] = True
+
+    for module in _MODULES:
+        for name in _functions_to_instrument(module):
+            function = getattr(module, name)
+            _originals[(module, name)] = function
+            setattr(module, name, _instrumented(function, module.__name__.split('.')[-1] + '.' + name))
+
+def disable_instrumentation():
+    """
+    This function puts the original functions back, and stops tracemalloc if it was started by enable_instrumentation.
+    The recorded calls are kept until clear_instrumentation_results is called.
+    """
+    for (module, name), function in _originals.items():
+        setattr(module, name, function)
+    _originals.clear()
+    if _state['started_tracemalloc']:
+        tracemalloc.stop()
+        _state['started_tracemalloc'] = False
+
+@contextlib.contextmanager
+def instrumentation(track_memory=True):
+    """
+    This context manager enables the instrumentation inside a with block:
+    with bh_instr.instrumentation():
+        data = bh_utils.merge_ids7_dt(df_ids7, df_dt)
+    """
+    enable_instrumentation(track_memory=track_memory)
+    try:
+        yield
+    finally:
+        disable_instrumentation()
+
+def get_instrumentation_results():
+    """
+    This function returns the recorded calls as a dataframe, in the order they were called, with the columns:
+    Stage, Depth, Wall time (s), Rows in, Rows out and Peak memory (MB).
+    """
+    return pd.DataFrame(_results, columns=_COLUMNS).astype({'Rows in': 'Int64', 'Rows out': 'Int64'})
+
+def save_instrumentation_results(file_path):
+    """
+    This function writes the recorded calls to a JSON file, as a list of records.
+    """
+    with open(file_path, 'w') as f:
+        json.dump([{column: record.get(column) for column in _COLUMNS} for record in _results], f, indent=2)
+
+def clear_instrumentation_results():
+    """
+    This function removes the recorded calls.
+    """
+    _results.clear()
@@ -1,87 +1,228 @@
 """
 This module contains functions for mapping the description content (column: 'Beskrivelse') to a new column (column: 'Mapped Procedures').
+
+The mapping dictionary is compiled once into a list of rules, and the rules are only evaluated on the unique
+descriptions in the data. All the criteria of the dictionary are found with one multi-pattern (Aho-Corasick) scan
+of each unique description, and the result for each unique description is then broadcast back to all the rows.
+
+If a cache folder is given to map_procedures, the rules matched by each description are stored on disk, in one file
+per mapping dictionary (named by a fingerprint of the dictionary). When a get_*_mapping_dict() function is changed,
+the fingerprint changes and a new cache file is used, so only the descriptions that have not been seen with the current
+dictionary are evaluated. The check for conflicting rules is always done on the descriptions in the current data.
 """
 
-def _perform_mapping(df_data, key, value):
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+def _compile_mapping(mapping):
     """
-    This utility function performs the mapping according to the following rules:
+    This utility function compiles the mapping dictionary into a list of rules according to the following rules:
     First the key is separated in to a list of criteria, separated by ' & '.
     Then each criteria is checked for the presence of '~' which indicates an exclusion criteria.
+    Each rule is a tuple of (key, value, inclusion_criteria, exclusion_criteria).
+    """
+    rules = []
+    for key, value in mapping.items():
+        key_list = key.split(' & ')
+        inclusion_criteria = [x for x in key_list if not x.startswith('~')]
+        exclusion_criteria = [x[1:] for x in key_list if x.startswith('~')]
+        rules.append((key, value, inclusion_criteria, exclusion_criteria))
+    return rules
+
+class _CriteriaAutomaton:
     """
+    A multi-pattern substring matcher (Aho-Corasick automaton) built from all the criteria in a mapping dictionary.
+    Each description is scanned once, character by character, and the indices of all the criteria found in it are returned.
+    The cost of a scan therefore does not grow with the number of criteria in the dictionary.
+    """
+    def __init__(self, patterns):
+        # The trie: one dictionary of character -> next state per state, state 0 is the root:
+        self.goto = [{}]
+        # The indices of the patterns that end in each state:
+        self.output = [set()]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(index)
+
+        # Build the failure links breadth first, so the failure state of a state is always completed before the state itself:
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                # A state also matches all the patterns of its failure state:
+                self.output[next_state] |= self.output[self.fail[next_state]]
+                queue.append(next_state)
 
-    def _check_criteria(description):
+        self.output = [frozenset(output) for output in self.output]
+
+    def find(self, text):
         """
-        This utility function checks whether all the inclusion and exclusion criteria are satisfied in
-        the description column 'Beskrivelse'.
+        Returns the set of indices of all the patterns that are substrings of the text.
         """
-        # Check if all inclusion criteria are present in the description:
-        if all(elem.lower() in description.lower() for elem in inclusion_criteria) & \
-            ~any(elem.lower() in description.lower() for elem in exclusion_criteria):
-            return True
-        else:
-            return False
-
-    # Get the inclusion and exclusion criteria:
-    key_list = key.split(' & ')
-    inclusion_criteria = [x for x in key_list if not x.startswith('~')]
-    exclusion_criteria = [x[1:] for x in key_list if x.startswith('~')]
-
-    # Check df_data's 'Beskrivelse' column for substrings of all the inclusion and exclusion criteria:
-    # 'Mapping Target' is set to True if all inclusion criteria are present and no exclusion criteria are present:
-    # This is a temporary column that is used to check whether we are mapping allready mapped columns.
-    df_data['Mapping Target'] = False
-    df_data.loc[df_data['Beskrivelse'].apply(_check_criteria), 'Mapping Target'] = True
-
-    # Check if no procedures were targeted by the mapping:
-    if sum(df_data['Mapping Target'] == True) == 0:
-        print('WARNING! No procedures were targeted by this mapping!')
-        print('\n')
-        df_data.drop('Mapping Target', axis=1, inplace=True)
-        return df_data
-
-    # Check if the mapping target is already mapped with a different value and give a warning and information if it is:
-    if sum((df_data['Mapping Target'] == True) & ~((df_data['Mapped Procedures'] == 'Unmapped') | (df_data['Mapped Procedures'] == value))) > 0:
-        print('\n')
-        print('-'*30)
-        print('\n')
-        print('WARNING! Some or all mapping targets are already mapped!')
-        print('\n')
-        # Print all the inclusion criteria with an ' & ' between them:
-        print('The current inclusion criteria are: ' + ' & '.join(inclusion_criteria))
-        print('The current exclusion criteria are: ' + ' & '.join(exclusion_criteria))
-        # Print a unique list of the already mapped procedures:
-        print('\n')
-        print('The following procedures are already mapped:')
-        mapped_list = df_data['Beskrivelse'][(df_data['Mapping Target'] == True) &  
-                                             (df_data['Mapped Procedures'] != 'Unmapped')].unique().tolist()
-        print('\n')
-
-        for item in mapped_list:
-            # Print the 'Beskrivelse' column ' -> ' the 'Mapped Procedures' column, only of the 'Mapped Procedure' differs from value:
-            if df_data['Mapped Procedures'][df_data['Beskrivelse'] == item].unique()[0] != value:
-                print(f'{item}   --->   {df_data["Mapped Procedures"][df_data["Beskrivelse"] == item].unique()[0]}')
-        print('\n')
-
-        print('Please check the mapping dictionary and refine it to avoid mapping the same procedure twice.')
-        print('\n')
-        print('-'*30)
-        print('\n')
-        df_data.drop('Mapping Target', axis=1, inplace=True)
-        return df_data    
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set(output[0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
 
-    # Map the procedures:
-    df_data.loc[df_data['Mapping Target'] == True, 'Mapped Procedures'] = value
+def _match_rules(descriptions, rules):
+    """
+    This utility function checks whether all the inclusion and exclusion criteria of each rule are satisfied
+    in each of the descriptions. The descriptions must be unique and lower case.
+    All the criteria are found in one scan of each description with the _CriteriaAutomaton, and each rule is then
+    resolved as set logic over the criteria that were found.
+    Returns a boolean matrix with one row per rule and one column per description.
+    """
+    criteria = sorted({elem.lower() for _, _, inclusion, exclusion in rules for elem in inclusion + exclusion})
+    criteria_index = {elem: i for i, elem in enumerate(criteria)}
+    automaton = _CriteriaAutomaton(criteria)
 
-    # Remove the temporary column:
-    df_data.drop('Mapping Target', axis=1, inplace=True)
+    # hits[i, j] is True if criteria i is a substring of description j:
+    hits = np.zeros((len(criteria), len(descriptions)), dtype=bool)
+    for j, description in enumerate(descriptions):
+        hits[list(automaton.find(description)), j] = True
 
-    return df_data
+    matches = np.zeros((len(rules), len(descriptions)), dtype=bool)
+    for i, (_, _, inclusion_criteria, exclusion_criteria) in enumerate(rules):
+        inclusion = [criteria_index[elem.lower()] for elem in inclusion_criteria]
+        exclusion = [criteria_index[elem.lower()] for elem in exclusion_criteria]
+        matches[i] = hits[inclusion].all(axis=0) & ~hits[exclusion].any(axis=0)
+    return matches
+
+def _mapping_fingerprint(mapping):
+    """
+    This utility function returns a fingerprint of the mapping dictionary. The order of the keys is included,
+    since the rules are applied in the order of the dictionary.
+    """
+    return hashlib.sha1(json.dumps(list(mapping.items()), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _match_rules_cached(descriptions, rules, cache_file):
+    """
+    This utility function returns the same boolean matrix as _match_rules, but looks up the descriptions in the cache file
+    first, and only evaluates the rules on the descriptions that are not in the cache. The cache file is a JSON file with
+    the indices of the matched rules for each (lower case) description, and it is updated with the new descriptions.
+    """
+    cache = {}
+    if cache_file.exists():
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            print('WARNING: Could not read the mapping cache: ' + str(cache_file))
+            print('The cache is rebuilt.')
+            cache = {}
+
+    new_descriptions = [description for description in descriptions if description not in cache]
+    if new_descriptions:
+        new_matches = _match_rules(new_descriptions, rules)
+        for j, description in enumerate(new_descriptions):
+            cache[description] = np.flatnonzero(new_matches[:, j]).tolist()
+        # Write to a temporary file first, so an interrupted write does not leave a broken cache.
+        # The temporary file has a unique name, so that processes writing the same cache at once do not collide:
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cache_file.parent, prefix=cache_file.name + '.',
+                                         suffix='.tmp', delete=False) as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(f.name, cache_file)
+
+    matches = np.zeros((len(rules), len(descriptions)), dtype=bool)
+    for j, description in enumerate(descriptions):
+        matches[cache[description], j] = True
+    return matches
+
+def _print_mapping_conflict(inclusion_criteria, exclusion_criteria, conflicting_items):
+    """
+    This utility function prints a warning when the targets of a mapping are already mapped with a different value.
+    conflicting_items is a list of (description, already mapped procedure) tuples.
+    """
+    print('\n')
+    print('-'*30)
+    print('\n')
+    print('WARNING! Some or all mapping targets are already mapped!')
+    print('\n')
+    # Print all the inclusion criteria with an ' & ' between them:
+    print('The current inclusion criteria are: ' + ' & '.join(inclusion_criteria))
+    print('The current exclusion criteria are: ' + ' & '.join(exclusion_criteria))
+    # Print a unique list of the already mapped procedures:
+    print('\n')
+    print('The following procedures are already mapped:')
+    print('\n')
+
+    for item, mapped in conflicting_items:
+        # Print the 'Beskrivelse' column ' -> ' the 'Mapped Procedures' column:
+        print(f'{item}   --->   {mapped}')
+    print('\n')
+
+    print('Please check the mapping dictionary and refine it to avoid mapping the same procedure twice.')
+    print('\n')
+    print('-'*30)
+    print('\n')
 
-def map_procedures(df_data, mapping, verbose=False):
+def _perform_mapping(descriptions, rules, verbose=False, cache_file=None):
+    """
+    This utility function performs the mapping of the unique descriptions rule by rule, in the order of the mapping dictionary.
+    If no descriptions are targeted by a rule, a warning is printed.
+    If any of the targets of a rule are already mapped with a different value, a warning is printed and the rule is skipped.
+    If cache_file is given, the matched rules are looked up in (and added to) the cache file.
+    Returns an array with the mapped procedure for each unique description.
+    """
+    lower_descriptions = [description.lower() for description in descriptions]
+    if cache_file is None:
+        matches = _match_rules(lower_descriptions, rules)
+    else:
+        matches = _match_rules_cached(lower_descriptions, rules, cache_file)
+    mapped = np.full(len(descriptions), 'Unmapped', dtype=object)
+
+    for (key, value, inclusion_criteria, exclusion_criteria), target in zip(rules, matches):
+        if verbose:
+            print(f'{key} -> {value}')
+
+        # Check if no procedures were targeted by the mapping:
+        if not target.any():
+            print('WARNING! No procedures were targeted by this mapping!')
+            print('\n')
+            continue
+
+        # Check if the mapping target is already mapped with a different value and give a warning and information if it is:
+        if (target & (mapped != 'Unmapped') & (mapped != value)).any():
+            conflicting_items = [(descriptions[i], mapped[i]) for i in np.flatnonzero(target & (mapped != 'Unmapped'))
+                                 if mapped[i] != value]
+            _print_mapping_conflict(inclusion_criteria, exclusion_criteria, conflicting_items)
+            continue
+
+        # Map the procedures:
+        mapped[target] = value
+
+    return mapped
+
+def map_procedures(df_data, mapping, verbose=False, cache_folder=None):
     """
     This function checks the relevant columns for the presence of the characters '&' and '~', which is used for mapping.
     It also initializes the 'Mapped Procedures' column and moves it to the front.
-    Finally the mapping dictionary is passed line by line to the _perform_mapping function.
+    Finally the mapping dictionary is compiled and evaluated on the unique descriptions by the _perform_mapping function,
+    and the result is broadcast back to all the rows.
+    If cache_folder is given, the rules matched by each description are cached in the folder, and only descriptions
+    that have not been mapped with the same mapping dictionary before are evaluated.
     """
         # Check the 'Beskrivelse' column for the following characters '&', '~':
     if sum(df_data['Beskrivelse'].str.contains('&')) > 0:
@@ -89,28 +230,35 @@ def map_procedures(df_data, mapping, verbose=False):
         print('This character is used to separate criteria for identifying procedures.')
         print('We need to find another separator character.')
         return
-    
+
     if sum(df_data['Beskrivelse'].str.contains('~')) > 0:
         print('WARNING! The "Beskrivelse" column contains the character "~".')
         print('This character is used to exclude criteria for identifying procedures.')
         print('We need to find another separator character.')
         return
 
-    # Initialize the 'Mapped Procedures' column:
-    df_data['Mapped Procedures'] = 'Unmapped'
+    # Find the unique descriptions, in order of first appearance, and the position of each row in the unique list:
+    codes, descriptions = pd.factorize(df_data['Beskrivelse'])
+    descriptions = list(descriptions)
 
-    # Move the 'Mapped Procedures' column to the front:
-    cols = df_data.columns.tolist()
-    cols.insert(0, cols.pop(cols.index('Mapped Procedures')))
-    df_data = df_data.reindex(columns=cols)
-   
     # Map the procedures:
     if verbose:
         print('Mapping procedures...\n')
 
-    for key, value in mapping.items():
-        if verbose:
-            print(f'{key} -> {value}')
-        df_data = _perform_mapping(df_data, key, value)
+    cache_file = None
+    if cache_folder is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        cache_file = Path(cache_folder) / ('mapping_' + _mapping_fingerprint(mapping) + '.json')
+
+    mapped = _perform_mapping(descriptions, _compile_mapping(mapping), verbose=verbose, cache_file=cache_file)
+
+    # Broadcast the mapping back to the rows. Rows without a description (code -1) are left unmapped:
+    mapped = np.append(mapped, 'Unmapped')
+    df_data['Mapped Procedures'] = mapped[codes]
 
-    return df_data
\ No newline at end of file
+    # Move the 'Mapped Procedures' column to the front:
+    cols = df_data.columns.tolist()
+    cols.insert(0, cols.pop(cols.index('Mapped Procedures')))
+    df_data = df_data.reindex(columns=cols)
+
+    return df_data
@@ -1,14 +1,35 @@
 
-import seaborn as sns
 import os
+import io
 import glob
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
 from xa_dose_analysis import reporting_module as bh_report
+from xa_dose_analysis import exposure_module as bh_exp
 
 # This module contains functions for performing the various common plots.
+# matplotlib and seaborn are imported when a plot function is called, not when this module is imported,
+# so that scripts that only clean, merge and map the data do not pay for importing them.
+
+def _import_plotting_libraries():
+    """
+    Imports and returns matplotlib.pyplot and seaborn. Python keeps imported modules, so only the first call is slow.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    return plt, sns
+
+def _remove_unused_categories(data, column):
+    """
+    If the column is categorical (e.g. after compact_dataframe), this function removes the categories that are not in the data,
+    so that seaborn only makes boxes for the values that are present.
+    """
+    if isinstance(data[column].dtype, pd.CategoricalDtype):
+        data = data.assign(**{column: data[column].cat.remove_unused_categories()})
+    return data
 
 def plot_representative_dose_by_procedure(data, y_max=20, save=False):
     """
@@ -19,8 +40,10 @@ def plot_representative_dose_by_procedure(data, y_max=20, save=False):
     The dots will represent the outliers.
     There will be one box per procedure
     """
+    plt, sns = _import_plotting_libraries()
 
     # Create a dataframe with the data for the procedure:
+    data = _remove_unused_categories(data, 'Mapped Procedures')
     data = data.sort_values(by=['Mapped Procedures'])
     
     # Make a boxplot:
@@ -107,31 +130,46 @@ def plot_air_kerma_angle_heatmap(exp_data, procedure_name, bin_size=10, plot_abs
     col_secondary = "Positioner Secondary Angle (deg)"
     col_ak = "Air Kerma (mGy)"
 
-    # Drop rows with missing values in the relevant columns:
-    df = exp_data[[col_primary, col_secondary, col_ak]].dropna()
+    # Sum the Air Kerma per angle bin (bins centered on multiples of bin_size, exposures with missing values are dropped):
+    heatmap_data = bh_exp.angle_heatmap_grid(exp_data[col_primary], exp_data[col_secondary], exp_data[col_ak], bin_size=bin_size)
 
-# Define bins covering the full range of possible angles (centered on multiples of bin_size):
-    half = bin_size / 2
-    primary_bins = np.arange(0 - half, 180 + half + bin_size, bin_size)
-    primary_bins = np.unique(np.concatenate([-primary_bins[::-1], primary_bins]))
-    secondary_bins = np.arange(0 - half, 90 + half + bin_size, bin_size)
-    secondary_bins = np.unique(np.concatenate([-secondary_bins[::-1], secondary_bins]))
+    _plot_angle_heatmap(heatmap_data, procedure_name, plot_absolute=plot_absolute, save=save)
 
-    # Bin the angles and sum the Air Kerma per bin:
-    df = df.copy()
-    df['primary_bin'] = pd.cut(df[col_primary], bins=primary_bins, right=False)
-    df['secondary_bin'] = pd.cut(df[col_secondary], bins=secondary_bins, right=False)
-    
-    heatmap_data = df.groupby(['secondary_bin', 'primary_bin'], observed=False)[col_ak].sum().unstack(fill_value=0)
+def plot_air_kerma_angle_heatmap_from_cube(cube, accession_numbers, procedure_name, plot_absolute=False, save=False):
+    """
+    Plots the same heatmaps as plot_air_kerma_angle_heatmap, from an angle histogram cube built once for all the exposures
+    with exposure_module.build_angle_histogram_cube, instead of from the exposures of the procedure.
+    The heatmaps are made from the sum of the cube over the accession numbers of the procedure.
+
+    Example:
+    cube = bh_exp.build_angle_histogram_cube(df_dt_exp, bin_size=10)
+    accession_numbers = data[data['Mapped Procedures'] == 'TAVI']['Accession Number'].unique()
+    bh_plot.plot_air_kerma_angle_heatmap_from_cube(cube, accession_numbers, 'TAVI')
+    """
+    heatmap_data = bh_exp.angle_heatmap_from_cube(cube, accession_numbers)
+    if heatmap_data is None:
+        return
+    _plot_angle_heatmap(heatmap_data, procedure_name, plot_absolute=plot_absolute, save=save)
+
+def _plot_angle_heatmap(heatmap_data, procedure_name, plot_absolute=False, save=False):
+    """
+    Plots the heatmaps of plot_air_kerma_angle_heatmap from a grid of Air Kerma per angle bin, with the secondary angle
+    bin centers as index and the primary angle bin centers as columns (both ascending).
+    """
+    plt, sns = _import_plotting_libraries()
 
     # Create axis labels from bin centers:
-    x_labels = [f"{int(b.left + half)}" for b in heatmap_data.columns]
-    y_labels = [f"{int(b.left + half)}" for b in heatmap_data.index]
+    x_labels = [f"{b}" for b in heatmap_data.columns]
+    y_labels = [f"{b}" for b in heatmap_data.index]
 
     # Reverse y-axis so cranial is on top:
     heatmap_data = heatmap_data.iloc[::-1]
     y_labels = y_labels[::-1]
 
+    if heatmap_data.values.sum() == 0:
+        print('WARNING: There is no Air Kerma in the angle bins for ' + procedure_name + '.')
+        return
+
     # Trim to only show bins that have data (with 1 bin margin):
     col_mask = heatmap_data.sum(axis=0) > 0
     row_mask = heatmap_data.sum(axis=1) > 0
@@ -201,7 +239,7 @@ def plot_air_kerma_angle_heatmap(exp_data, procedure_name, bin_size=10, plot_abs
 
     plt.show()
 
-def plot_representative_dose(data, procedure, y_max=20, save=False):
+def plot_representative_dose(data, procedure, y_max=20, save=False, seed=None):
     """
     This function will create a boxplot with whiskers.
     The line in the middle will represent the median.
@@ -209,10 +247,21 @@ def plot_representative_dose(data, procedure, y_max=20, save=False):
     The whiskers will represent the 2.5th to 97.5th percentile.
     The dots will represent the outliers.
     There will be one box per room that has performed the procedure.
+    Pass an int as seed to get the same bootstrap confidence intervals in the printed summaries every run.
     """
+    _plot_representative_dose(data, procedure, y_max=y_max, save=save, seed=seed)
+    return
+
+def _plot_representative_dose(data, procedure, y_max=20, save=False, seed=None):
+    """
+    This function makes the plot of plot_representative_dose, and returns the figure and the summary tables
+    printed by print_summary_inc_cak and print_summary_per_lab.
+    """
+    plt, sns = _import_plotting_libraries()
 
     # Create a dataframe with the data for the procedure: .str.contains
     data = data[data['Mapped Procedures'] == procedure]
+    data = _remove_unused_categories(data, 'Modality Room')
     data = data.sort_values(by=['Modality Room'])
     
     # Make a boxplot:
@@ -221,9 +270,9 @@ def plot_representative_dose(data, procedure, y_max=20, save=False):
     print('Reporting doses for ' + procedure + ':')
     print('\n')
     #bh_report.print_summary(data[data['Mapped Procedures'] == procedure], True)
-    bh_report.print_summary_inc_cak(data[data['Mapped Procedures'] == procedure], True)
+    summary = bh_report._print_summary_inc_cak(data[data['Mapped Procedures'] == procedure], True, seed=seed)
     print('\n')
-    bh_report.print_summary_per_lab(data[data['Mapped Procedures'] == procedure], True)
+    summary_per_lab = bh_report._print_summary_per_lab(data[data['Mapped Procedures'] == procedure], True, seed=seed)
     # Reduce the range of the y-axis:
     if y_max > 0:
         ax.set_ylim([0, y_max])
@@ -275,7 +324,74 @@ def plot_representative_dose(data, procedure, y_max=20, save=False):
         # if the procedure contains a forward slash, replace it with a dash:
         procedure = procedure.replace('/', '-')
         fig.savefig('Figures/' + procedure + '.png', bbox_inches='tight')
-    return
+    return fig, summary, summary_per_lab
+
+def _use_agg_backend():
+    """
+    This function switches matplotlib to the non-interactive Agg backend, used by plot_representative_dose_batch
+    and its worker processes. Returns the backend that was used before, so that it can be restored.
+    """
+    import matplotlib
+    backend = matplotlib.get_backend()
+    matplotlib.use('Agg')
+    return backend
+
+def _plot_representative_dose_job(job, seed=None):
+    """
+    This function runs one job of plot_representative_dose_batch: it plots and saves the figure of the procedure,
+    closes the figure, and returns the printed output and the summary tables.
+    """
+    plt, _ = _import_plotting_libraries()
+    data, procedure, y_max = job
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        fig, summary, summary_per_lab = _plot_representative_dose(data, procedure, y_max=y_max, save=True, seed=seed)
+    plt.close(fig)
+    return output.getvalue(), summary, summary_per_lab
+
+def plot_representative_dose_batch(data, jobs, n_workers=1, seed=None):
+    """
+    This function makes the plots of plot_representative_dose for a list of (procedure, y_max) jobs, and saves them
+    in the Figures folder. The figures are not shown.
+    The figures are rendered with the Agg backend. With n_workers > 1 (or None for all cores), the jobs are run in
+    parallel worker processes. With n_workers=1 they are run in this process, and its backend is restored afterwards.
+    The printed summaries are the same as with plot_representative_dose, and are printed in the order of the jobs.
+    Returns a dictionary with the summary tables of each procedure: {procedure: {'summary': ..., 'summary_per_lab': ...}}
+    Pass an int as seed to get the same confidence intervals as plot_representative_dose with the same seed.
+
+    Example:
+    jobs = [('PCI', 100), ('Angiografi', 50), ('TAVI', 200)]
+    summaries = bh_plot.plot_representative_dose_batch(data, jobs, n_workers=4, seed=42)
+    """
+    # Only send the rows of each procedure to the workers:
+    job_data = [(data[data['Mapped Procedures'] == procedure], procedure, y_max) for procedure, y_max in jobs]
+    run_job = partial(_plot_representative_dose_job, seed=seed)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(jobs))
+
+    summaries = {}
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_use_agg_backend) as executor:
+            # map returns the results in the same order as the jobs:
+            results = executor.map(run_job, job_data)
+            for (procedure, _), (output, summary, summary_per_lab) in zip(jobs, results):
+                print(output, end='')
+                summaries[procedure] = {'summary': summary, 'summary_per_lab': summary_per_lab}
+    else:
+        # The figures are rendered with the Agg backend here too, and the backend of the caller is restored after:
+        backend = _use_agg_backend()
+        try:
+            for (procedure, _), job in zip(jobs, job_data):
+                output, summary, summary_per_lab = run_job(job)
+                print(output, end='')
+                summaries[procedure] = {'summary': summary, 'summary_per_lab': summary_per_lab}
+        finally:
+            import matplotlib
+            matplotlib.use(backend)
+
+    return summaries
 
 
 
@@ -0,0 +1,142 @@
+"""
+This module contains functions for running SQL queries with DuckDB directly on the Parquet files of the store
+(see store_module) and of the import cache (see import_excel_files_to_dataframe), without loading the data into pandas.
+DuckDB reads only the columns and row groups a query needs, and can work on data larger than the memory, so questions
+over years of exposure level data return only the (small) result as a dataframe.
+
+DuckDB is an optional dependency: pip install duckdb
+
+Example (the number of exposures with each protocol per room and month, as in script_assess_fluoromode):
+from xa_dose_analysis import query_module as bh_query
+connection = bh_query.connect(store_folder='store', parquet_views={'exposures': 'cache/exposures'})
+counts = bh_query.query(connection, '''
+    SELECT "Modality Room", date_trunc('month', "Study Date") AS "Month", "Acquisition Protocol Name", count(*) AS n
+    FROM exposures
+    WHERE "Modality Room" = ? AND "Study Date" >= ?
+    GROUP BY ALL ORDER BY ALL''', ['KRH_XA8', '2023-06-01'])
+
+The merged data can be mapped and registered as a view, so that the procedures can be joined with the exposures:
+bh_query.register_mapped_view(connection, mapping_dict_PCI.get_PCI_mapping_dict())
+bh_query.query(connection, '''
+    SELECT m."Mapped Procedures", count(*) AS n, median(e."Air Kerma (mGy)") AS "Median Air Kerma (mGy)"
+    FROM exposures e JOIN mapped m USING ("Accession Number")
+    GROUP BY ALL''')
+
+-------------------------------- Functions: --------------------------------
+connect:                    Opens a DuckDB connection with views of the store tables (ids7, dt and merged) and of any
+                            other Parquet files or folders, e.g. the import cache of the exposure level exports.
+
+register_parquet_view:      Registers a view of a Parquet file, of all the Parquet files in a folder, or of a glob pattern.
+
+register_dataframe_view:    Registers a view of a pandas dataframe.
+
+register_mapped_view:       Maps the procedures of the merged data (map_procedures) and registers the result as a view.
+
+query:                      Runs a SQL query and returns the result as a dataframe.
+-------------------------------------------------------------------------------------
+"""
+
+import importlib.util
+from pathlib import Path
+
+from xa_dose_analysis import mapping_module as bh_map
+
+_STORE_TABLES = ['ids7', 'dt', 'merged']
+
+def _check_for_duckdb():
+    """
+    This utility function checks that DuckDB is installed, and prints a warning if it is not.
+    """
+    if importlib.util.find_spec('duckdb') is None:
+        print('WARNING: duckdb is not installed, so the data cannot be queried with SQL.')
+        print('Install duckdb (pip install duckdb) to enable the queries.')
+        print('\n')
+        return False
+    return True
+
+def _sql_string(value):
+    """
+    This utility function quotes a string (e.g. a path) as a SQL string literal.
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _sql_identifier(name):
+    """
+    This utility function quotes a name (e.g. a view name) as a SQL identifier.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+def register_parquet_view(connection, name, path):
+    """
+    This function registers a view with the given name of a Parquet file, of all the Parquet files in a folder
+    (e.g. an import cache folder) or of a glob pattern. The files are read with union_by_name, so files with
+    different columns (e.g. exports from different years) can be combined; missing columns are NULL.
+    Note that an import cache folder also holds the cached files of Excel files that have since been deleted.
+    Returns False (with a warning) if there are no Parquet files at the path.
+    """
+    if Path(path).is_dir():
+        path = Path(path) / '*.parquet'
+    if not list(Path(path).parent.glob(Path(path).name)):
+        print('WARNING: There are no Parquet files at: ' + str(path))
+        return False
+    connection.execute('CREATE OR REPLACE VIEW ' + _sql_identifier(name) + ' AS SELECT * FROM read_parquet('
+                       + _sql_string(Path(path).as_posix()) + ', union_by_name = true)')
+    return True
+
+def register_dataframe_view(connection, name, df):
+    """
+    This function registers a view with the given name of a pandas dataframe. The dataframe is not copied,
+    so it must not be changed while the view is used.
+    """
+    connection.register(name, df)
+
+def connect(store_folder=None, parquet_views=None, database=':memory:', verbose=False):
+    """
+    This function opens a DuckDB connection, and registers the views:
+    ids7, dt and merged:    The tables of the store in store_folder (the ones that exist), if store_folder is given.
+    parquet_views:          A dictionary with the name of each view and the path of its Parquet file, folder or glob
+                            pattern, e.g. {'exposures': 'cache/exposures'}.
+    The database is in memory by default, and only holds the views, not the data.
+    Returns the connection, or None (with a warning) if DuckDB is not installed.
+    """
+    if not _check_for_duckdb():
+        return
+    import duckdb
+
+    connection = duckdb.connect(database)
+    views = {}
+    if store_folder is not None:
+        views.update({table: Path(store_folder) / (table + '.parquet') for table in _STORE_TABLES
+                      if (Path(store_folder) / (table + '.parquet')).exists()})
+        if not views:
+            print('WARNING: There are no tables in the store: ' + str(store_folder))
+            print('Run update_merged_store to create them.')
+    if parquet_views is not None:
+        views.update(parquet_views)
+
+    for name, path in views.items():
+        if register_parquet_view(connection, name, path) and verbose:
+            print('Registered the view ' + name + ' of: ' + str(path))
+    return connection
+
+def register_mapped_view(connection, mapping, name='mapped', source='merged', verbose=False):
+    """
+    This function maps the procedures of the merged data in the view source (default the merged table of the store)
+    with map_procedures, and registers the result as a view with the given name, with the column 'Mapped Procedures'.
+    The mapping is done in pandas, but the merged data has one row per procedure, so it is small compared to the
+    exposure level data it is joined with.
+    Returns the mapped dataframe.
+    """
+    data = connection.execute('SELECT * FROM ' + _sql_identifier(source)).df()
+    data = bh_map.map_procedures(data, mapping, verbose=verbose)
+    if data is None:
+        return
+    register_dataframe_view(connection, name, data)
+    return data
+
+def query(connection, sql, parameters=None):
+    """
+    This function runs a SQL query on the connection, and returns the result as a dataframe.
+    Values can be passed as parameters, with a ? for each value in the query (or $name with a dictionary).
+    """
+    return connection.execute(sql, parameters).df()
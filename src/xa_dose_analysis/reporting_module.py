@@ -1,24 +1,39 @@
 # This module contains utility function to report various properties of the data.
+# The statistics are calculated by summarise_metrics in a single groupby pass, and the print_* and report_* 
+# functions format and print the resulting table. The print_* and report_* functions return None, as they are used as the
+# last line of the notebook cells. The _print_* and _report_* versions also return the table, so that it can be exported
+# with the same (bootstrap) values as printed, without recomputation.
 
+import numpy as np
 import pandas as pd
 
-def _calc_ci(data_vector, ci = 95, n = 10000):
+def _calc_ci(data_vector, ci = 95, n = 10000, seed = None, max_chunk_size = 2**22):
     """
     This function calculated the confidence interval of the median of the data_vector.
-    The default number of bootstrap samples is 1000.
+    The default number of bootstrap samples is 10000.
+    The resample indices are drawn with NumPy in chunks of at most max_chunk_size values, 
+    and the medians of all the bootstrap samples in a chunk are calculated at once.
+    Pass an int or a numpy Generator as seed to get the same confidence interval every run.
     """
-    # Create an empty list to store the medians of the bootstrap samples:
-    medians = []
-    # Create a for loop to create the bootstrap samples:
-    for i in range(n):
-        # Create a bootstrap sample:
-        sample = data_vector.sample(frac=1, replace=True)
-        # Calculate the median of the bootstrap sample:
-        medians.append(sample.median())
+    values = np.asarray(data_vector, dtype=float)
+    if len(values) == 0:
+        return np.nan, np.nan
+    rng = np.random.default_rng(seed)
+    # Missing values are skipped when calculating the median, as in pandas:
+    median = np.nanmedian if np.isnan(values).any() else np.median
+    # Create the bootstrap samples and calculate the medians, one chunk at a time:
+    medians = np.empty(n)
+    chunk = max(1, max_chunk_size // len(values))
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        sample_index = rng.integers(0, len(values), size=(stop - start, len(values)))
+        with np.errstate(all='ignore'):
+            medians[start:stop] = median(values[sample_index], axis=1)
     # Create a pandas series of the medians:
-    ci = pd.Series(medians)
-    # Return the median and the confidence interval:
-    return ci.quantile(0.025), ci.quantile(0.975)
+    medians = pd.Series(medians)
+    # Return the confidence interval:
+    alpha = (100 - ci) / 200
+    return medians.quantile(alpha), medians.quantile(1 - alpha)
 
 def _format_min_sec(data_vector):
     """
@@ -35,130 +50,153 @@ def _format_min_sec(data_vector):
         seconds = str(round(seconds))
     return minutes, seconds
 
-
-def print_obs_per_lab(data):
-    for lab in data['Modality Room'].unique():
-        print(lab + ': n = ' + str(len(data[data['Modality Room'] == lab])))
-
-def print_median_dap_per_lab(data):
-    for lab in data['Modality Room'].unique():
-        print(lab + ': DAP = ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 1)) + ' Gy*cm2')
-
-def print_summary_per_lab(data, ci = False):
-    data = data.sort_values(by=['Modality Room'])
-    for lab in data['Modality Room'].unique():
-        if ci:
-            lci, uci = _calc_ci(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'])
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-              ', DAP: Median - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 2)) + ' (Gy*cm2),' + \
-              (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-              # 25 th percentile:
-              ' IQR [' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.25), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.75), 2)) + '], ' + \
-              'Range (' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].min(), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].max(), 2)) + ').')
-
-def print_summary_per_lab_inc_cak(data, ci = False):
-    data = data.sort_values(by=['Modality Room'])
-    for lab in data['Modality Room'].unique():
-        if ci:
-            lci, uci = _calc_ci(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'])
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-              ', DAP: Median - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 2)) + ' (Gy*cm2),' + \
-              (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-              # 25 th percentile:
-              ' IQR [' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.25), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.75), 2)) + '], ' + \
-              'Range (' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].min(), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].max(), 2)) + ').')
+def summarise_metrics(data, metrics, group_by=None, ci=False, seed=None):
+    """
+    This function calculates the summary statistics of one or more metrics (columns) in a single groupby pass.
+    The data is grouped by the group_by column(s), or treated as one group if group_by is None.
+    Returns a tidy dataframe with one row per group and metric, and the columns:
+    the group_by column(s), 'Metric', 'n' (number of rows in the group), 'Median', 'CI lower', 'CI upper' 
+    (95% bootstrap confidence interval of the median, only if ci is True), 'Q1', 'Q3', 'Min' and 'Max'.
+    The table can be printed with the print_* functions in this module, or exported directly.
+    """
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    if isinstance(group_by, str):
+        group_by = [group_by]
+
+    # Without group_by columns, all the rows are put in the same group:
+    keys = group_by if group_by else np.zeros(len(data), dtype=int)
+    grouped = data.groupby(keys, observed=True, sort=True)
+    n_rows = grouped.size()
+    rng = np.random.default_rng(seed)
+
+    tables = []
+    for metric in metrics:
+        values = grouped[metric]
+        table = pd.DataFrame({'n': n_rows,
+                              'Median': values.median(),
+                              'Q1': values.quantile(0.25),
+                              'Q3': values.quantile(0.75),
+                              'Min': values.min(),
+                              'Max': values.max()})
+        if not group_by:
+            # Report an empty group rather than no group at all, if there is no data:
+            table = table.reindex([0])
+            table['n'] = table['n'].fillna(0).astype(int)
         if ci:
-            lci_cak, uci_cak = _calc_ci(data[data['Modality Room'] == lab]['CAK (mGy)'])
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-              ', CAK: Median - ' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].median(), 2)) + ' (mGy),' + \
-              (' 95% CI: [' + str(round(lci_cak, 2)) + ' - ' + str(round(uci_cak, 2)) + ']' if ci else '') + \
-              # 25 th percentile:
-              ' IQR [' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].quantile(0.25), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].quantile(0.75), 2)) + '], ' + \
-              'Range (' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].min(), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].max(), 2)) + ').')
-
-def print_summary(data, ci = False):
-    if ci:
-        lci, uci = _calc_ci(data['DAP Total (Gy*cm2)'])
-
-    print('Alle: n = {:4}'.format(len(data)) + ', DAP: Median - ' + str(round(data['DAP Total (Gy*cm2)'].median(), 1)) + ',' +\
-            (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-            # 25 th percentile:
-            ' IQR [' + str(round(data['DAP Total (Gy*cm2)'].quantile(0.25), 1)) + \
-            ' - ' + str(round(data['DAP Total (Gy*cm2)'].quantile(0.75), 1)) + '], ' + \
-            'Range (' + str(round(data['DAP Total (Gy*cm2)'].min(), 1)) + \
-            ' - ' + str(round(data['DAP Total (Gy*cm2)'].max(), 1)) + ').')
-
-def print_summary_inc_cak(data, ci = False):
-    if ci:
-        lci, uci = _calc_ci(data['DAP Total (Gy*cm2)'])
-
-    print('Alle: n = {:4}'.format(len(data)) + ', DAP: Median - ' + str(round(data['DAP Total (Gy*cm2)'].median(), 1)) + ',' +\
-            (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-            # 25 th percentile:
-            ' IQR [' + str(round(data['DAP Total (Gy*cm2)'].quantile(0.25), 1)) + \
-            ' - ' + str(round(data['DAP Total (Gy*cm2)'].quantile(0.75), 1)) + '], ' + \
-            'Range (' + str(round(data['DAP Total (Gy*cm2)'].min(), 1)) + \
-            ' - ' + str(round(data['DAP Total (Gy*cm2)'].max(), 1)) + ').')
-    if ci:
-        lci, uci = _calc_ci(data['CAK (mGy)'])
-
-    print('Alle: n = {:4}'.format(len(data)) + ', CAK: Median - ' + str(round(data['CAK (mGy)'].median(), 1)) + ',' +\
-            (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-            # 25 th percentile:
-            ' IQR [' + str(round(data['CAK (mGy)'].quantile(0.25), 1)) + \
-            ' - ' + str(round(data['CAK (mGy)'].quantile(0.75), 1)) + '], ' + \
-            'Range (' + str(round(data['CAK (mGy)'].min(), 1)) + \
-            ' - ' + str(round(data['CAK (mGy)'].max(), 1)) + ').')
+            # The bootstrap must be done per group, but reuses the row positions of the groups:
+            column = data[metric].to_numpy()
+            indices = grouped.indices
+            bounds = [_calc_ci(column[indices[key]] if key in indices else [], seed=rng) for key in table.index]
+            table.insert(2, 'CI lower', [lower for lower, _ in bounds])
+            table.insert(3, 'CI upper', [upper for _, upper in bounds])
+        table.insert(0, 'Metric', metric)
+        tables.append(table)
+
+    stats = pd.concat(tables)
+    if group_by:
+        stats = stats.reset_index()
+    else:
+        stats = stats.reset_index(drop=True)
+    return stats
 
-def report_exposure_time_all(data, ci = False):
-    if ci:
-        lci, uci = _calc_ci(data['F+A Time (s)'])
-    
-    median_min, median_sec = _format_min_sec(data['F+A Time (s)'].median())
+def _format_summary(label, row, name, unit, digits, ci):
+    """
+    This function formats one row of the summarise_metrics table as a line with n, median, CI, IQR and range.
+    The CI is always rounded to two decimals.
+    """
+    return (label + ': n = {:4}'.format(int(row['n'])) + \
+           ', ' + name + ': Median - ' + str(round(row['Median'], digits)) + (' ' + unit if unit else '') + ',' + \
+           (' 95% CI: [' + str(round(row['CI lower'], 2)) + ' - ' + str(round(row['CI upper'], 2)) + ']' if ci else '') + \
+           # 25 th percentile:
+           ' IQR [' + str(round(row['Q1'], digits)) + \
+           ' - ' + str(round(row['Q3'], digits)) + '], ' + \
+           'Range (' + str(round(row['Min'], digits)) + \
+           ' - ' + str(round(row['Max'], digits)) + ').')
+
+def _format_exposure_time_summary(label, row, ci):
+    """
+    This function formats one row of the summarise_metrics table for the exposure time as a line with n, median, CI,
+    IQR and range in minutes and seconds.
+    """
+    median_min, median_sec = _format_min_sec(row['Median'])
     
     if ci:
-        lci_min, lci_sec = _format_min_sec(lci)
-        uci_min, uci_sec = _format_min_sec(uci)
+        lci_min, lci_sec = _format_min_sec(row['CI lower'])
+        uci_min, uci_sec = _format_min_sec(row['CI upper'])
     
-    lIQR_min, lIQR_sec = _format_min_sec(data['F+A Time (s)'].quantile(0.25))
-    uIQR_min, uIQR_sec = _format_min_sec(data['F+A Time (s)'].quantile(0.75))
-    lrange_min, lrange_sec = _format_min_sec(data['F+A Time (s)'].min())
-    urange_min, urange_sec = _format_min_sec(data['F+A Time (s)'].max())
+    lIQR_min, lIQR_sec = _format_min_sec(row['Q1'])
+    uIQR_min, uIQR_sec = _format_min_sec(row['Q3'])
+    lrange_min, lrange_sec = _format_min_sec(row['Min'])
+    urange_min, urange_sec = _format_min_sec(row['Max'])
 
-    print('All '+ ': n = {:4}'.format(len(data)) + \
+    return (label + ': n = {:4}'.format(int(row['n'])) + \
         ', Exposure time: Median - ' + median_min + ':' + median_sec + ' (min:s),' + \
         (' 95% CI: [' + lci_min + ':' + lci_sec + ' - ' + uci_min + ':' + uci_sec + ']' if ci else '') + \
         # 25 th percentile:
         ' IQR [' + lIQR_min + ':' + lIQR_sec + ' - ' + uIQR_min + ':' + uIQR_sec + '], ' + \
         'Range (' + lrange_min + ':' + lrange_sec + ' - '  + urange_min + ':' + urange_sec + ').')
 
-def report_exposure_time_per_lab(data, ci = False):
-    data = data.sort_values(by=['Modality Room'])
-    
+
+def print_obs_per_lab(data):
     for lab in data['Modality Room'].unique():
-        if ci:
-            lci, uci = _calc_ci(data[data['Modality Room'] == lab]['F+A Time (s)'])
-        
-        median_min, median_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].median())
-        
-        if ci:
-            lci_min, lci_sec = _format_min_sec(lci)
-            uci_min, uci_sec = _format_min_sec(uci)
-        
-        lIQR_min, lIQR_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].quantile(0.25))
-        uIQR_min, uIQR_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].quantile(0.75))
-        lrange_min, lrange_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].min())
-        urange_min, urange_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].max())
-
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-        ', Exposure time: Median - ' + median_min + ':' + median_sec + ' (min:s),' + \
-        (' 95% CI: [' + lci_min + ':' + lci_sec + ' - ' + uci_min + ':' + uci_sec + ']' if ci else '') + \
-        # 25 th percentile:
-        ' IQR [' + lIQR_min + ':' + lIQR_sec + ' - ' + uIQR_min + ':' + uIQR_sec + '], ' + \
-        'Range (' + lrange_min + ':' + lrange_sec + ' - '  + urange_min + ':' + urange_sec + ').')
\ No newline at end of file
+        print(lab + ': n = ' + str(len(data[data['Modality Room'] == lab])))
+
+def print_median_dap_per_lab(data):
+    for lab in data['Modality Room'].unique():
+        print(lab + ': DAP = ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 1)) + ' Gy*cm2')
+
+def _print_summary_per_lab(data, ci = False, seed = None):
+    stats = summarise_metrics(data, 'DAP Total (Gy*cm2)', group_by='Modality Room', ci=ci, seed=seed)
+    for _, row in stats.iterrows():
+        print(_format_summary(row['Modality Room'], row, 'DAP', '(Gy*cm2)', 2, ci))
+    return stats
+
+def print_summary_per_lab(data, ci = False, seed = None):
+    _print_summary_per_lab(data, ci, seed)
+
+def _print_summary_per_lab_inc_cak(data, ci = False, seed = None):
+    stats = summarise_metrics(data, ['DAP Total (Gy*cm2)', 'CAK (mGy)'], group_by='Modality Room', ci=ci, seed=seed)
+    dap = stats[stats['Metric'] == 'DAP Total (Gy*cm2)']
+    cak = stats[stats['Metric'] == 'CAK (mGy)']
+    for (_, dap_row), (_, cak_row) in zip(dap.iterrows(), cak.iterrows()):
+        print(_format_summary(dap_row['Modality Room'], dap_row, 'DAP', '(Gy*cm2)', 2, ci))
+        print(_format_summary(cak_row['Modality Room'], cak_row, 'CAK', '(mGy)', 2, ci))
+    return stats
+
+def print_summary_per_lab_inc_cak(data, ci = False, seed = None):
+    _print_summary_per_lab_inc_cak(data, ci, seed)
+
+def _print_summary(data, ci = False, seed = None):
+    stats = summarise_metrics(data, 'DAP Total (Gy*cm2)', ci=ci, seed=seed)
+    print(_format_summary('Alle', stats.iloc[0], 'DAP', '', 1, ci))
+    return stats
+
+def print_summary(data, ci = False, seed = None):
+    _print_summary(data, ci, seed)
+
+def _print_summary_inc_cak(data, ci = False, seed = None):
+    stats = summarise_metrics(data, ['DAP Total (Gy*cm2)', 'CAK (mGy)'], ci=ci, seed=seed)
+    print(_format_summary('Alle', stats.iloc[0], 'DAP', '', 1, ci))
+    print(_format_summary('Alle', stats.iloc[1], 'CAK', '', 1, ci))
+    return stats
+
+def print_summary_inc_cak(data, ci = False, seed = None):
+    _print_summary_inc_cak(data, ci, seed)
+
+def _report_exposure_time_all(data, ci = False, seed = None):
+    stats = summarise_metrics(data, 'F+A Time (s)', ci=ci, seed=seed)
+    print(_format_exposure_time_summary('All ', stats.iloc[0], ci))
+    return stats
+
+def report_exposure_time_all(data, ci = False, seed = None):
+    _report_exposure_time_all(data, ci, seed)
+
+def _report_exposure_time_per_lab(data, ci = False, seed = None):
+    stats = summarise_metrics(data, 'F+A Time (s)', group_by='Modality Room', ci=ci, seed=seed)
+    for _, row in stats.iterrows():
+        print(_format_exposure_time_summary(row['Modality Room'], row, ci))
+    return stats
+
+def report_exposure_time_per_lab(data, ci = False, seed = None):
+    _report_exposure_time_per_lab(data, ci, seed)
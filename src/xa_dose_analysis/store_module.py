@@ -0,0 +1,263 @@
+"""
+This module contains functions for keeping a persistent store of the cleaned and merged IDS7 and DoseTrack data.
+
+The store is a folder with the following files (Parquet files require pyarrow):
+manifest.json:      The IDS7 and DoseTrack Excel files that have been ingested, with their size and modification time.
+ids7.parquet:       The cleaned IDS7 rows (after the filters, checks and the overwrite of duplicated accession numbers),
+                    with the accession number from the export in the column 'Original Henvisnings-ID'.
+dt.parquet:         The DoseTrack rows, with the column Henvisning_i_ids7.
+merged.parquet:     The merged data, as returned by merge_ids7_dt.
+
+When new exports are added to the folders, update_merged_store only imports, cleans and merges the new (or changed) files.
+Accession numbers that straddle old and new files are handled by re-processing all the stored IDS7 rows of the affected
+patients and accession numbers from their original accession numbers, and re-merging the affected accession numbers. Everything else is kept as it is.
+The cost of a monthly update is therefore proportional to the new data, not to the full dataset.
+
+-------------------------------- Functions: --------------------------------
+update_merged_store:    Ingests the new and changed Excel files in the IDS7 and DoseTrack folders into the store,
+                        and returns the merged data.
+
+load_merged_store:      Loads the merged data (or the cleaned IDS7 or DoseTrack data) from the store.
+-------------------------------------------------------------------------------------
+"""
+
+import json
+import os
+import importlib.util
+from pathlib import Path
+
+import pandas as pd
+
+from xa_dose_analysis import dt_ids7_export_module as bh_utils
+
+_TABLES = ['ids7', 'dt', 'merged']
+# The accession number from the IDS7 export, before overwrite_duplicated_accession_numbers:
+_COL_ORIGINAL_ACCESSION = 'Original Henvisnings-ID'
+
+def _scan_folder(root_folder):
+    """
+    This function returns a dictionary with the size and modification time of all the Excel files in the folder tree,
+    keyed by the path relative to the root folder.
+    """
+    files = {}
+    for file_path in sorted(Path(root_folder).rglob("*.xlsx")):
+        stat = file_path.stat()
+        files[file_path.relative_to(root_folder).as_posix()] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return files
+
+def _load_manifest(store_folder):
+    """
+    This function loads the manifest of the ingested files, or returns an empty manifest if the store is new.
+    """
+    manifest_file = Path(store_folder) / 'manifest.json'
+    if not manifest_file.exists():
+        return {'ids7': {}, 'dt': {}}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+def _write_table(df, path):
+    """
+    This function writes a table of the store as Parquet.
+    Text columns with mixed types (e.g. numbers and text in the same Excel column) cannot be written as Parquet,
+    so if the first attempt fails, these columns are converted to text and a warning is printed.
+    """
+    try:
+        df.to_parquet(path, index=False)
+    except Exception:
+        df = df.copy()
+        for column in df.columns:
+            if pd.api.types.infer_dtype(df[column], skipna=True).startswith('mixed'):
+                print('WARNING: The column "' + column + '" has mixed types, and is stored as text.')
+                df[column] = df[column].astype('str')
+        df.to_parquet(path, index=False)
+
+def _load_table(store_folder, table):
+    """
+    This function loads one of the tables in the store, or returns None if it does not exist.
+    """
+    path = Path(store_folder) / (table + '.parquet')
+    if not path.exists():
+        return None
+    return pd.read_parquet(path)
+
+def _changed_files(old_files, new_files):
+    """
+    This function compares two scans of a folder, and returns the files that are new or changed,
+    and the files that are changed or removed (whose stored rows must be dropped).
+    """
+    to_import = [name for name, stat in new_files.items() if old_files.get(name) != stat]
+    to_drop = [name for name, stat in old_files.items() if new_files.get(name) != stat]
+    return to_import, to_drop
+
+def _column_values(df, column):
+    """
+    This function returns the set of non-missing values in a column, or an empty set if the column does not exist.
+    """
+    if df is None or column not in df.columns:
+        return set()
+    return set(df[column].dropna())
+
+def update_merged_store(store_folder, ids7_folder, dt_folder, n_workers=1, cache_folder=None,
+                        verbose=False, review_file=None):
+    """
+    This function updates the persistent store of cleaned and merged data with the new and changed Excel files in
+    the IDS7 and DoseTrack folders, and returns the merged data.
+    On the first run, all the files are ingested, which is the same as running import_excel_files_to_dataframe,
+    run_all_cleanup_filters_and_checks and merge_ids7_dt on the full folders.
+    On later runs, only the new and changed files are imported, cleaned and merged, and the rows from changed or removed
+    files are replaced. The arguments n_workers and cache_folder are passed to the import, and review_file
+    to overwrite_duplicated_accession_numbers.
+    """
+    if importlib.util.find_spec('pyarrow') is None:
+        print('WARNING: pyarrow is not installed, so the store cannot be written.')
+        print('Install pyarrow to use the store.')
+        print('\n')
+        return
+
+    os.makedirs(store_folder, exist_ok=True)
+    manifest = _load_manifest(store_folder)
+    scan = {'ids7': _scan_folder(ids7_folder), 'dt': _scan_folder(dt_folder)}
+    ids7_import, ids7_drop = _changed_files(manifest['ids7'], scan['ids7'])
+    dt_import, dt_drop = _changed_files(manifest['dt'], scan['dt'])
+
+    if not (ids7_import or ids7_drop or dt_import or dt_drop):
+        if verbose:
+            print('The store is up to date.')
+        return _load_table(store_folder, 'merged')
+
+    if verbose:
+        print('New or changed files: {} IDS7, {} DoseTrack.'.format(len(ids7_import), len(dt_import)))
+        print('Changed or removed files: {} IDS7, {} DoseTrack.'.format(len(ids7_drop), len(dt_drop)))
+
+    df_ids7_stored = _load_table(store_folder, 'ids7')
+    df_dt_stored = _load_table(store_folder, 'dt')
+    df_merged = _load_table(store_folder, 'merged')
+
+    # Import the new and changed files:
+    df_ids7_new = None
+    if ids7_import:
+        df_ids7_new = bh_utils._import_excel_files([Path(ids7_folder) / name for name in ids7_import], n_workers=n_workers,
+                                                   cache_folder=cache_folder, root_folder=ids7_folder)
+        # Stop execution if the dataframe contains the column 'Fødselsnummer':
+        if bh_utils._check_for_fnr(df_ids7_new):
+            return
+
+    df_dt_new = None
+    if dt_import:
+        df_dt_new = bh_utils._import_excel_files([Path(dt_folder) / name for name in dt_import], n_workers=n_workers,
+                                                 cache_folder=cache_folder, root_folder=dt_folder)
+        if bh_utils._check_for_column(df_dt_new, 'DoseTrack', 'Accession Number'):
+            if df_dt_new['Accession Number'].str.match(r'^[0-9]{7}$').sum() > 0:
+                df_dt_new = bh_utils._convert_old_siemens_pacs_accession_format(df_dt_new, verbose=verbose)
+
+    # Drop the stored rows from changed and removed files, and keep track of the accession numbers and patients they affect:
+    affected_accessions = set()
+    affected_patients = set()
+    if df_ids7_stored is not None and ids7_drop:
+        dropped = df_ids7_stored['Source_File'].isin(ids7_drop)
+        affected_accessions |= _column_values(df_ids7_stored[dropped], 'Henvisnings-ID')
+        affected_patients |= _column_values(df_ids7_stored[dropped], 'Pasient')
+        df_ids7_stored = df_ids7_stored[~dropped]
+    if df_dt_stored is not None and dt_drop:
+        dropped = df_dt_stored['Source_File'].isin(dt_drop)
+        affected_accessions |= _column_values(df_dt_stored[dropped], 'Accession Number')
+        df_dt_stored = df_dt_stored[~dropped]
+
+    # All the DoseTrack data is needed to check which IDS7 accession numbers are in DoseTrack:
+    dt_tables = [df for df in [df_dt_stored, df_dt_new] if df is not None]
+    if not dt_tables:
+        print('WARNING: There is no DoseTrack data in the store or in: ' + str(dt_folder))
+        print('Without DoseTrack data, there is nothing to merge.')
+        print('\n')
+        return
+    df_dt = pd.concat(dt_tables, ignore_index=True)
+    affected_accessions |= _column_values(df_dt_new, 'Accession Number')
+
+    # Filter the new IDS7 rows:
+    if df_ids7_new is not None:
+        pipeline = bh_utils.build_cleanup_pipeline(df_ids7_new, verbose=verbose)
+        df_ids7_new = pipeline.run()
+        if verbose:
+            print(pipeline.summary().to_string(index=False))
+            print('\n')
+        # Keep the accession number from the export, as overwrite_duplicated_accession_numbers may replace it:
+        df_ids7_new[_COL_ORIGINAL_ACCESSION] = df_ids7_new['Henvisnings-ID']
+        affected_accessions |= _column_values(df_ids7_new, 'Henvisnings-ID')
+        affected_patients |= _column_values(df_ids7_new, 'Pasient')
+
+    # Re-process all the stored IDS7 rows of the affected patients, so that bookings on the same patient and time
+    # are always checked together, and the stored rows of the affected accession numbers (both the original and the
+    # overwritten accession number, so that a new or removed DoseTrack accession number finds its IDS7 rows):
+    df_ids7_keep = df_ids7_stored
+    df_ids7_redo = None
+    if df_ids7_stored is not None:
+        if _COL_ORIGINAL_ACCESSION not in df_ids7_stored.columns:
+            # Stores from before the original accession number was kept:
+            df_ids7_stored = df_ids7_stored.assign(**{_COL_ORIGINAL_ACCESSION: df_ids7_stored['Henvisnings-ID']})
+        redo = (df_ids7_stored['Henvisnings-ID'].isin(affected_accessions)
+                | df_ids7_stored[_COL_ORIGINAL_ACCESSION].isin(affected_accessions))
+        if 'Pasient' in df_ids7_stored.columns:
+            affected_patients |= _column_values(df_ids7_stored[redo], 'Pasient')
+            redo |= df_ids7_stored['Pasient'].isin(affected_patients)
+        df_ids7_redo = df_ids7_stored[redo].drop(columns=['Henvisning_i_dt'])
+        df_ids7_keep = df_ids7_stored[~redo]
+        # The merged rows of the overwritten accession numbers are replaced, and the overwrite is redone from the
+        # original accession numbers:
+        affected_accessions |= _column_values(df_ids7_redo, 'Henvisnings-ID')
+        df_ids7_redo['Henvisnings-ID'] = df_ids7_redo[_COL_ORIGINAL_ACCESSION]
+
+    ids7_tables = [df for df in [df_ids7_redo, df_ids7_new] if df is not None]
+    if not ids7_tables:
+        print('WARNING: There is no IDS7 data in the store or in: ' + str(ids7_folder))
+        print('Without IDS7 data, there is nothing to merge.')
+        print('\n')
+        return
+    df_ids7_redo = pd.concat(ids7_tables, ignore_index=True)
+    affected_accessions |= _column_values(df_ids7_redo, 'Henvisnings-ID')
+    df_ids7_redo = bh_utils.check_accession_ids7_vs_dt(df_ids7_redo, df_dt, verbose=verbose)
+    df_ids7_redo = bh_utils.overwrite_duplicated_accession_numbers(df_ids7_redo, df_dt, verbose=verbose, review_file=review_file)
+    affected_accessions |= _column_values(df_ids7_redo, 'Henvisnings-ID')
+    df_ids7 = pd.concat([df for df in [df_ids7_keep, df_ids7_redo] if df is not None], ignore_index=True)
+
+    # Update the column Henvisning_i_ids7 for the DoseTrack rows of the affected accession numbers:
+    if 'Henvisning_i_ids7' not in df_dt.columns:
+        df_dt['Henvisning_i_ids7'] = False
+    df_dt['Henvisning_i_ids7'] = df_dt['Henvisning_i_ids7'].fillna(False)
+    redo_dt = df_dt['Accession Number'].isin(affected_accessions)
+    df_dt.loc[redo_dt, 'Henvisning_i_ids7'] = df_dt.loc[redo_dt, 'Accession Number'].isin(_column_values(df_ids7, 'Henvisnings-ID'))
+    df_dt['Henvisning_i_ids7'] = df_dt['Henvisning_i_ids7'].astype(bool)
+
+    # Merge the affected accession numbers, and replace them in the stored merged data:
+    df_merged_new = bh_utils.merge_ids7_dt(df_ids7[df_ids7['Henvisnings-ID'].isin(affected_accessions)],
+                                           df_dt[redo_dt], verbose=verbose)
+    if df_merged is not None:
+        df_merged = df_merged[~df_merged['Accession Number'].isin(affected_accessions)]
+    df_merged = pd.concat([df for df in [df_merged, df_merged_new] if df is not None], ignore_index=True)
+    # Sort by accession number, as merge_ids7_dt does for the full dataset:
+    df_merged = df_merged.sort_values(by=['Accession Number'], ignore_index=True)
+
+    # Save the store, and the manifest last, so an interrupted update is re-done on the next run:
+    _write_table(df_ids7, Path(store_folder) / 'ids7.parquet')
+    _write_table(df_dt, Path(store_folder) / 'dt.parquet')
+    _write_table(df_merged, Path(store_folder) / 'merged.parquet')
+    with open(Path(store_folder) / 'manifest.json', 'w') as f:
+        json.dump(scan, f, indent=2)
+
+    if verbose:
+        print('The store has merged data of length: {}'.format(len(df_merged)))
+
+    return df_merged
+
+def load_merged_store(store_folder, table='merged'):
+    """
+    This function loads the merged data from the store.
+    Pass table='ids7' or table='dt' to load the cleaned IDS7 or DoseTrack data instead.
+    """
+    if table not in _TABLES:
+        print('WARNING: The table must be one of: ' + ', '.join(_TABLES))
+        return
+    df = _load_table(store_folder, table)
+    if df is None:
+        print('WARNING: There is no ' + table + ' table in the store: ' + str(store_folder))
+        print('Run update_merged_store to create it.')
+    return df
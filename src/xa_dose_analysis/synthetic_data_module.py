@@ -0,0 +1,245 @@
+"""
+This module contains functions for generating synthetic IDS7 and DoseTrack data, with the same column names and the same
+kinds of errors as the real exports, but without any patient data. It is used for benchmarking and for trying out the
+functions in this package outside the secure machine.
+
+The synthetic data includes:
+Accession numbers in the valid formats (NKRH, NRRH, NIRH, NRUL, ... with 16 characters and MUAH_ with 12 characters),
+some with an invalid format, and old 7 digit Siemens PACS numbers in the DoseTrack data (the MUAH_ numbers without MUAH_).
+Bookings on the same patient and time with different accession numbers, where only one is in DoseTrack.
+Cancelled procedures, phantom/test procedures and bookings without time.
+Descriptions made from the criteria in the mapping dictionaries.
+DoseTrack accession numbers that are not in IDS7.
+
+-------------------------------- Functions: --------------------------------
+generate_ids7:              Generates an IDS7 worklist export with n_rows rows.
+
+generate_dt:                Generates a procedure level DoseTrack export (one row per series, as the Ordinal == 1 rows)
+                            for the accession numbers of an IDS7 export.
+
+generate_dt_exposures:      Generates an exposure level DoseTrack export (one row per exposure, with the columns
+                            'Ordinal', 'Irradiation Event Type', 'Air Kerma (mGy)', and the C-arm angles) for a
+                            procedure level DoseTrack export. The Ordinal == 1 rows are the procedure level rows.
+
+generate_dataset:           Generates all of the above: df_ids7, df_dt, df_dt_exp = generate_dataset(100000, seed=1)
+
+write_excel_files:          Splits a dataframe into Excel files in a folder, to be read by import_excel_files_to_dataframe.
+-------------------------------------------------------------------------------------
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from xa_dose_analysis.mapping_dicts import mapping_dict_DSA, mapping_dict_PCI, mapping_dict_rad_xa, mapping_dict_elfys
+
+_ACCESSION_PREFIXES = ['NKRH', 'NRRH', 'NIRH', 'NORRH', 'NRUL', 'NKUL', 'NNRH']
+_ROOMS = ['KRH_XA3', 'KRH_XA6', 'KRH_XA7', 'KRH_XA8', 'IRH_XA6', 'IRH_XA7', 'KUL_XA1', 'KUL_XA2', 'RRH_XA1', 'RRH_XA5']
+_CATEGORIES = ['Poliklinisk', 'Innlagt', 'Dagpasient']
+_PROTOCOLS = {'Fluoroscopy': ['Fluoro Low', 'Fluoro Normal', 'Fluoro High', 'Roadmap'],
+              'Stationary Acquisition': ['Cardiac 15 fps', 'DSA 3 fps', 'DSA 6 fps', 'Single Shot']}
+
+def _description_vocabulary(mappings=None, n_descriptions=2000, rng=None):
+    """
+    This utility function returns a list of descriptions made by joining 1 to 3 criteria from the mapping dictionaries
+    with ', ', as the procedure codes are concatenated in IDS7. Criteria with the characters '&' and '~' are not used.
+    """
+    if mappings is None:
+        mappings = [mapping_dict_DSA.get_DSA_mapping_dict(), mapping_dict_PCI.get_PCI_mapping_dict(),
+                    mapping_dict_rad_xa.get_rad_xa_mapping_dict(), mapping_dict_elfys.get_elfys_mapping_dict()]
+    criteria = sorted({criterion for mapping in mappings for key in mapping for criterion in key.split(' & ')
+                       if not criterion.startswith('~') and '&' not in criterion and '~' not in criterion})
+    criteria = np.array(criteria, dtype=object)
+    n_criteria = rng.integers(1, 4, n_descriptions)
+    return [', '.join(sorted(rng.choice(criteria, n, replace=False))) for n in n_criteria]
+
+def _zero_padded(numbers, width):
+    """
+    This utility function converts an array of integers to zero padded strings.
+    """
+    return pd.Series(numbers).astype(str).str.zfill(width).to_numpy(dtype=object)
+
+def generate_ids7(n_rows, seed=None, mappings=None, duplicated_fraction=0.03, cancelled_fraction=0.02,
+                  phantom_fraction=0.005, invalid_fraction=0.005, nat_fraction=0.003):
+    """
+    This function generates an IDS7 worklist export with n_rows rows, with the columns used by this package.
+    There are about 1.25 rows per accession number (some accession numbers have several procedure codes), and
+    about 2 accession numbers per patient.
+    The fractions give the share of accession numbers that are booked on the same patient and time as another
+    accession number, cancelled, phantoms, or have an invalid format, and the share of rows without booking time.
+    The descriptions are made from the criteria in the mappings (a list of mapping dictionaries, default: DSA, PCI,
+    rad_xa and elfys).
+    """
+    rng = np.random.default_rng(seed)
+    n_accessions = max(1, int(n_rows / 1.25))
+    n_patients = max(1, n_accessions // 2)
+
+    # Accession numbers: a prefix and the accession index, 16 characters (12 for MUAH_):
+    index = np.arange(n_accessions)
+    prefix = rng.choice(_ACCESSION_PREFIXES, n_accessions)
+    accession = np.empty(n_accessions, dtype=object)
+    for p in _ACCESSION_PREFIXES:
+        is_prefix = prefix == p
+        accession[is_prefix] = p + _zero_padded(index[is_prefix], 16 - len(p))
+    is_muah = rng.random(n_accessions) < 0.05
+    accession[is_muah] = 'MUAH_' + _zero_padded(index[is_muah] % 10**7, 7)
+    is_invalid = rng.random(n_accessions) < invalid_fraction
+    accession[is_invalid] = 'NKRH' + _zero_padded(index[is_invalid], 10)
+
+    patient = rng.integers(0, n_patients, n_accessions)
+    booked = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365 * 24 * 12, n_accessions) * 5, unit='min')
+    booked = booked.to_numpy().copy()
+
+    # Bookings on the same patient and time as the previous accession number:
+    is_duplicated = rng.random(n_accessions) < duplicated_fraction
+    is_duplicated[0] = False
+    duplicated = np.flatnonzero(is_duplicated)
+    patient[duplicated] = patient[duplicated - 1]
+    booked[duplicated] = booked[duplicated - 1]
+
+    cancelled = rng.random(n_accessions) < cancelled_fraction
+    phantom = rng.random(n_accessions) < phantom_fraction
+    room = rng.choice(_ROOMS, n_accessions)
+    sex = rng.choice(['M', 'K'], n_patients)
+
+    # Each accession number has at least one row, the remaining rows are extra procedure codes:
+    row_accession = np.sort(np.concatenate([index, rng.integers(0, n_accessions, max(0, n_rows - n_accessions))]))[:n_rows]
+    descriptions = np.array(_description_vocabulary(mappings, rng=rng), dtype=object)
+    booked_rows = pd.Series(booked[row_accession])
+    booked_rows[rng.random(n_rows) < nat_fraction] = pd.NaT
+
+    df_ids7 = pd.DataFrame({
+        'Prioritet- og lesemerkeikon': pd.Series(np.nan, index=range(n_rows), dtype=float),
+        'Lagt til i demonstrasjon-ikon': pd.Series(np.nan, index=range(n_rows), dtype=float),
+        'Status': 'Godkjent',
+        'Henvisnings-ID': accession[row_accession],
+        'Pasient': 'P' + _zero_padded(patient[row_accession], 9).astype(object),
+        'Kjønn': sex[patient[row_accession]],
+        'Bestilt dato og tidspunkt': booked_rows,
+        'Beskrivelse': rng.choice(descriptions, n_rows),
+        'Rom/modalitet (RIS)': room[row_accession],
+        'Avbrutt': pd.Series('Avbrutt', index=range(n_rows), dtype='str').where(cancelled[row_accession]),
+        'Henvisningskategori (RIS)': np.where(phantom[row_accession], 'X Fantom/objekt/dyr/test',
+                                              rng.choice(_CATEGORIES, n_rows)),
+    })
+    return df_ids7
+
+def generate_dt(df_ids7, seed=None, coverage=0.9, duplicated_coverage=0.2, extra_fraction=0.02, old_siemens_fraction=0.5):
+    """
+    This function generates a procedure level DoseTrack export for the accession numbers in an IDS7 export.
+    A share (coverage) of the valid, performed accession numbers is in DoseTrack, with 1 or 2 rows (series) each.
+    Of the accession numbers booked on the same patient and time as another one, only a share (duplicated_coverage)
+    is in DoseTrack. A share (extra_fraction) of DoseTrack accession numbers that are not in IDS7 are added,
+    and a share (old_siemens_fraction) of the MUAH_ numbers are written in the old 7 digit Siemens PACS format.
+    """
+    rng = np.random.default_rng(seed)
+    accessions = df_ids7.drop_duplicates('Henvisnings-ID')
+    performed = accessions['Avbrutt'].isna() & (accessions['Henvisningskategori (RIS)'] != 'X Fantom/objekt/dyr/test')
+    performed &= accessions['Henvisnings-ID'].str.len().isin([12, 16]).to_numpy()
+
+    # The accession numbers booked on the same patient and time as an earlier accession number:
+    duplicated = accessions.duplicated(['Pasient', 'Bestilt dato og tidspunkt']) & accessions['Bestilt dato og tidspunkt'].notna()
+    in_dt = performed & (rng.random(len(accessions)) < np.where(duplicated, duplicated_coverage, coverage))
+    accessions = accessions[in_dt.to_numpy()]
+
+    n_extra = int(len(accessions) * extra_fraction)
+    extra = 'NKRH' + _zero_padded(10**11 + np.arange(n_extra), 12).astype(object)
+    accession = np.concatenate([accessions['Henvisnings-ID'].to_numpy(dtype=object), extra])
+    study_date = np.concatenate([accessions['Bestilt dato og tidspunkt'].to_numpy(dtype='datetime64[ns]'),
+                                 (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n_extra), unit='D')).to_numpy()])
+    room = np.concatenate([accessions['Rom/modalitet (RIS)'].to_numpy(dtype=object), rng.choice(_ROOMS, n_extra)])
+
+    # 1 or 2 series per accession number:
+    n_series = 1 + (rng.random(len(accession)) < 0.2)
+    row = np.repeat(np.arange(len(accession)), n_series)
+    n_rows = len(row)
+
+    old_siemens = pd.Series(accession).str.startswith('MUAH_').to_numpy() & (rng.random(len(accession)) < old_siemens_fraction)
+    accession = accession.copy()
+    accession[old_siemens] = pd.Series(accession[old_siemens], dtype=object).str[5:].to_numpy(dtype=object)
+
+    dap = rng.lognormal(2.5, 1.0, n_rows)
+    df_dt = pd.DataFrame({
+        'Accession Number': accession[row],
+        'Study Date': pd.Series(study_date[row]).dt.normalize(),
+        'Age (Years)': rng.integers(0, 95, len(accession))[row],
+        'DAP Total (Gy*cm2)': dap,
+        'CAK (mGy)': dap * rng.lognormal(2.0, 0.4, n_rows),
+        'F+A Time (s)': rng.lognormal(5.5, 0.8, n_rows),
+        'Modality Room': room[row],
+    })
+    df_dt['Accession Number'] = df_dt['Accession Number'].astype('str')
+    return df_dt
+
+def generate_dt_exposures(df_dt, seed=None, n_rows=None, mean_exposures=30):
+    """
+    This function generates an exposure level DoseTrack export for a procedure level DoseTrack export.
+    Each procedure level row is expanded into exposures with the Ordinal 1, 2, ..., and the procedure level columns are
+    repeated on each exposure, so that the rows with Ordinal == 1 are the procedure level export.
+    The Air Kerma and Dose Area Product of the exposures add up to the CAK and DAP Total of the procedure.
+    If n_rows is given, the number of exposures is n_rows (at least one per procedure level row),
+    otherwise there are on average mean_exposures per procedure level row.
+    """
+    rng = np.random.default_rng(seed)
+    n_procedures = len(df_dt)
+    if n_rows is None:
+        n_exposures = 1 + rng.poisson(mean_exposures - 1, n_procedures)
+    elif n_rows < n_procedures:
+        df_dt = df_dt.iloc[:n_rows]
+        n_procedures = n_rows
+        n_exposures = np.ones(n_procedures, dtype=int)
+    else:
+        n_exposures = 1 + rng.multinomial(n_rows - n_procedures, np.full(n_procedures, 1 / n_procedures))
+
+    procedure = np.repeat(np.arange(n_procedures), n_exposures)
+    n_rows = len(procedure)
+    ordinal = np.arange(n_rows) - np.repeat(np.cumsum(n_exposures) - n_exposures, n_exposures) + 1
+
+    # Split the procedure doses over the exposures:
+    share = rng.exponential(1.0, n_rows)
+    share /= np.bincount(procedure, weights=share)[procedure]
+
+    event_type = np.where(rng.random(n_rows) < 0.85, 'Fluoroscopy', 'Stationary Acquisition')
+    protocol = np.where(event_type == 'Fluoroscopy',
+                        rng.choice(_PROTOCOLS['Fluoroscopy'], n_rows),
+                        rng.choice(_PROTOCOLS['Stationary Acquisition'], n_rows))
+
+    df_dt_exp = df_dt.iloc[procedure].reset_index(drop=True)
+    df_dt_exp['Ordinal'] = ordinal
+    df_dt_exp['Irradiation Event Type'] = event_type
+    df_dt_exp['Acquisition Protocol Name'] = protocol
+    df_dt_exp['Air Kerma (mGy)'] = df_dt_exp['CAK (mGy)'].to_numpy() * share
+    df_dt_exp['Dose Area Product (Gy*cm2)'] = df_dt_exp['DAP Total (Gy*cm2)'].to_numpy() * share
+    df_dt_exp['Positioner Primary Angle (deg)'] = np.clip(rng.normal(0, 35, n_rows), -180, 180).round(1)
+    df_dt_exp['Positioner Secondary Angle (deg)'] = np.clip(rng.normal(0, 15, n_rows), -90, 90).round(1)
+    return df_dt_exp
+
+def generate_dataset(n_rows, seed=None, mappings=None, n_exposure_rows=None):
+    """
+    This function generates an IDS7 export with n_rows rows, the procedure level DoseTrack export for it,
+    and the exposure level DoseTrack export (with n_exposure_rows rows, default n_rows).
+    Returns df_ids7, df_dt, df_dt_exp
+    """
+    seeds = np.random.SeedSequence(seed).spawn(3)
+    df_ids7 = generate_ids7(n_rows, seed=seeds[0], mappings=mappings)
+    df_dt = generate_dt(df_ids7, seed=seeds[1])
+    if n_exposure_rows is None:
+        n_exposure_rows = n_rows
+    df_dt_exp = generate_dt_exposures(df_dt, seed=seeds[2], n_rows=n_exposure_rows)
+    return df_ids7, df_dt, df_dt_exp
+
+def write_excel_files(df, folder, n_files=1, prefix='export'):
+    """
+    This function splits a dataframe into n_files Excel files in the folder, named prefix_1.xlsx, prefix_2.xlsx, ...
+    Note that an Excel sheet holds at most 1048576 rows.
+    Returns the list of file paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    file_paths = []
+    for i, part in enumerate(np.array_split(np.arange(len(df)), n_files)):
+        file_path = Path(folder) / f'{prefix}_{i + 1}.xlsx'
+        df.iloc[part].to_excel(file_path, index=False)
+        file_paths.append(file_path)
+    return file_paths
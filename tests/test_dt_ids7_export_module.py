@@ -0,0 +1,41 @@
+"""
+Tests for the review of ambiguous accession numbers in dt_ids7_export_module.
+"""
+
+import contextlib
+import io
+
+import pandas as pd
+
+from xa_dose_analysis import dt_ids7_export_module as bh_utils
+
+_TIME = pd.Timestamp('2025-01-01 08:00')
+
+def _review_data():
+    """
+    Two patients with three accession numbers booked at the same time, of which two are in DoseTrack.
+    """
+    df_ids7 = pd.DataFrame({'Pasient': ['P1'] * 3 + ['P2'] * 3, 'Bestilt dato og tidspunkt': _TIME,
+                            'Henvisnings-ID': ['A', 'B', 'C', 'D', 'E', 'F'], 'Beskrivelse': list('xyzxyz')})
+    df_dt = pd.DataFrame({'Accession Number': ['A', 'B', 'D', 'E']})
+    with contextlib.redirect_stdout(io.StringIO()):
+        review = bh_utils.get_accession_number_review_table(df_ids7, df_dt)
+        df_ids7 = bh_utils.check_accession_ids7_vs_dt(df_ids7, df_dt)
+    return df_ids7, df_dt, review
+
+def test_apply_review_without_chosen_accession_numbers():
+    df_ids7, df_dt, review = _review_data()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = bh_utils.apply_accession_number_review(df_ids7.copy(), df_dt, review, verbose=True)
+    assert 'No reviewed accession numbers to apply' in output.getvalue()
+    pd.testing.assert_frame_equal(result, df_ids7)
+
+def test_apply_review_skips_invalid_choices():
+    df_ids7, df_dt, review = _review_data()
+    review.loc[review['Pasient'] == 'P1', 'Valgt Henvisnings-ID'] = 'B'
+    # F is not in DoseTrack, so the group of P2 is skipped:
+    review.loc[review['Pasient'] == 'P2', 'Valgt Henvisnings-ID'] = 'F'
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = bh_utils.apply_accession_number_review(df_ids7.copy(), df_dt, review, verbose=True)
+    assert result['Henvisnings-ID'].tolist() == ['A', 'B', 'B', 'D', 'E', 'F']
@@ -0,0 +1,95 @@
+"""
+Tests for store_module: the incremental update of the store must give the same merged data as a full run of
+import_excel_files_to_dataframe, run_all_cleanup_filters_and_checks and merge_ids7_dt on the same folders.
+"""
+
+import contextlib
+import io
+
+import pandas as pd
+import pytest
+
+from xa_dose_analysis import dt_ids7_export_module as bh_utils
+from xa_dose_analysis import store_module as bh_store
+
+pytest.importorskip('pyarrow')
+
+_TIME = pd.Timestamp('2025-01-06 08:00')
+
+def _accession(i):
+    return 'NKRH' + str(i).zfill(12)
+
+def _ids7_rows():
+    """
+    Ten patients with one accession number each, and one patient (P00) with two accession numbers (A and B)
+    booked at the same time.
+    """
+    rows = [{'Henvisnings-ID': _accession(i), 'Beskrivelse': 'RGA Cor PCI', 'Pasient': 'P' + str(i).zfill(2),
+             'Bestilt dato og tidspunkt': _TIME + pd.Timedelta(hours=i), 'Avbrutt': None,
+             'Henvisningskategori (RIS)': 'A'} for i in range(1, 11)]
+    rows.append({'Henvisnings-ID': _accession(100), 'Beskrivelse': 'RGA Cor PCI', 'Pasient': 'P00',
+                 'Bestilt dato og tidspunkt': _TIME, 'Avbrutt': None, 'Henvisningskategori (RIS)': 'A'})
+    rows.append({'Henvisnings-ID': _accession(101), 'Beskrivelse': 'RGA Cor Koronarangiografi (int.)', 'Pasient': 'P00',
+                 'Bestilt dato og tidspunkt': _TIME, 'Avbrutt': None, 'Henvisningskategori (RIS)': 'A'})
+    return pd.DataFrame(rows)
+
+def _dt_rows(accessions):
+    return pd.DataFrame({'Accession Number': accessions,
+                         'Study Date': _TIME,
+                         'DAP Total (Gy*cm2)': [float(i + 1) for i in range(len(accessions))],
+                         'CAK (mGy)': 10.0,
+                         'F+A Time (s)': 60.0,
+                         'Modality Room': 'KRH_XA3'})
+
+def _full_run(ids7_folder, dt_folder):
+    df_ids7 = bh_utils.import_excel_files_to_dataframe(ids7_folder)
+    df_dt = bh_utils.import_excel_files_to_dataframe(dt_folder)
+    df_ids7 = bh_utils.run_all_cleanup_filters_and_checks(df_ids7, df_dt)
+    return bh_utils.merge_ids7_dt(df_ids7, df_dt)
+
+def _assert_same_as_full_run(store_folder, ids7_folder, dt_folder):
+    with contextlib.redirect_stdout(io.StringIO()):
+        incremental = bh_store.update_merged_store(store_folder, ids7_folder, dt_folder)
+        full = _full_run(ids7_folder, dt_folder)
+    pd.testing.assert_frame_equal(incremental[list(full.columns)].reset_index(drop=True), full.reset_index(drop=True))
+    return incremental
+
+def test_update_after_dosetrack_file_added_and_removed(tmp_path):
+    ids7_folder, dt_folder, store_folder = tmp_path / 'ids7', tmp_path / 'dt', tmp_path / 'store'
+    ids7_folder.mkdir()
+    dt_folder.mkdir()
+    _ids7_rows().to_excel(ids7_folder / 'ids7_1.xlsx', index=False)
+    # Only A of patient P00 is in DoseTrack, so B is overwritten with A:
+    _dt_rows([_accession(i) for i in range(1, 11)] + [_accession(100)]).to_excel(dt_folder / 'dt_1.xlsx', index=False)
+    merged = _assert_same_as_full_run(store_folder, ids7_folder, dt_folder)
+    assert _accession(101) not in set(merged['Accession Number'])
+
+    # A new DoseTrack file with B: both are in DoseTrack, so B is no longer overwritten:
+    _dt_rows([_accession(101)]).to_excel(dt_folder / 'dt_2.xlsx', index=False)
+    merged = _assert_same_as_full_run(store_folder, ids7_folder, dt_folder)
+    assert _accession(101) in set(merged['Accession Number'])
+
+    # Removing the file again gives the first result:
+    (dt_folder / 'dt_2.xlsx').unlink()
+    merged = _assert_same_as_full_run(store_folder, ids7_folder, dt_folder)
+    assert _accession(101) not in set(merged['Accession Number'])
+
+def test_update_without_ids7_files(tmp_path):
+    ids7_folder, dt_folder, store_folder = tmp_path / 'ids7', tmp_path / 'dt', tmp_path / 'store'
+    ids7_folder.mkdir()
+    dt_folder.mkdir()
+    _dt_rows([_accession(1)]).to_excel(dt_folder / 'dt_1.xlsx', index=False)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        assert bh_store.update_merged_store(store_folder, ids7_folder, dt_folder) is None
+    assert 'WARNING: There is no IDS7 data' in output.getvalue()
+
+def test_update_without_dosetrack_files(tmp_path):
+    ids7_folder, dt_folder, store_folder = tmp_path / 'ids7', tmp_path / 'dt', tmp_path / 'store'
+    ids7_folder.mkdir()
+    dt_folder.mkdir()
+    _ids7_rows().to_excel(ids7_folder / 'ids7_1.xlsx', index=False)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        assert bh_store.update_merged_store(store_folder, ids7_folder, dt_folder) is None
+    assert 'WARNING: There is no DoseTrack data' in output.getvalue()